@@ -1,16 +1,23 @@
 import subprocess
 import sys
 import os
+import csv
+import tempfile
 import pandas as pd
 import requests
-from fastapi import FastAPI
+from typing import List, Literal, Optional
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import Response
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
-from utils import load_model, cleanup_csv_files
-from recommendations import get_similar_songs_by_mood
-from mood_analysis import calculate_moods
+from utils import load_model, get_model_version, cleanup_work_dir
+from recommendations import get_similar_songs_by_mood, recommend_for_moods, MOOD_LABELS, LASTFM_API_KEY
+from mood_analysis import calculate_moods, get_skipped_tracks
+from playlist_state import load_state, save_state, build_state, diff_playlist, apply_diff, overall_from_state
+from linktocsvconverter import extract_playlist_id, scrape_playlist_to_csv
+from resilience import Deadline, REQUEST_BUDGET, TRACK_BUDGET
+from response_format import compact_response, json_response, MAX_PAGE_SIZE
 
 # ==============================
 # FASTAPI SETUP
@@ -28,6 +35,19 @@ app.add_middleware(
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# Quota del tempo residuo assegnata a ogni step: la risoluzione degli UUID e
+# le feature si dividono il budget, le raccomandazioni usano quel che resta.
+# Lo scraping della playlist (nel worker) ha a disposizione REQUEST_BUDGET; il
+# tempo per traccia si aggiunge quando si conosce il numero di tracce.
+STAGE_SHARES = {
+    "uuid": 0.45,
+    "features": 0.6,
+}
+
+# Margine concesso a un sottoprocesso oltre la sua scadenza per scrivere il CSV;
+# poi viene terminato (ad esempio se resta bloccato su una chiamata)
+SUBPROCESS_GRACE = 5.0
+
 # ==============================
 # IMAGE PROXY ENDPOINT (per CORS)
 # ==============================
@@ -55,6 +75,14 @@ async def get_image(url: str):
 
 class PlaylistRequest(BaseModel):
     playlist_url: str
+    # Rielabora solo le tracce aggiunte rispetto all'ultima analisi salvata
+    incremental: bool = False
+    # Risposta compatta: campi delle tracce, layout e paginazione di "tracks".
+    # Senza queste opzioni la risposta contiene tutte le tracce con tutti i campi.
+    fields: Optional[List[str]] = None
+    layout: Literal["records", "columnar"] = "records"
+    page: int = Field(1, ge=1)
+    page_size: Optional[int] = Field(None, ge=1, le=MAX_PAGE_SIZE)
 
 # ==============================
 # CARICA MODELLO
@@ -66,45 +94,95 @@ model = load_model()
 # PIPELINE ORCHESTRATOR
 # ==============================
 
-# Esegue la pipeline completa
-def run_pipeline(playlist_url: str):
-    
-    # Definiamo i percorsi dei file CSV temporanei
-    csv_1 = os.path.join(BASE_DIR, "playlist_tracks.csv")
-    csv_2 = os.path.join(BASE_DIR, "playlist_with_uuid.csv")
-    csv_3 = os.path.join(BASE_DIR, "playlist_with_features.csv")
-
-    # Otteniamo il CSV dalla playlist Spotify
-    p1 = subprocess.run(
-        [sys.executable, os.path.join(BASE_DIR, "linktocsvconverter.py"), playlist_url, csv_1],
+# Esegue uno script della pipeline in un sottoprocesso, che eredita la scadenza dello step
+def run_script(script: str, *args: str, deadline: Deadline = None):
+    deadline = deadline or Deadline()
+    remaining = deadline.remaining()
+    p = subprocess.run(
+        [sys.executable, os.path.join(BASE_DIR, script), *args],
         check=False,
         capture_output=True,
         text=True,
+        env={**os.environ, **deadline.env()},
+        timeout=remaining + SUBPROCESS_GRACE if remaining is not None else None,
     )
-    if p1.returncode != 0:
-        raise subprocess.CalledProcessError(p1.returncode, p1.args, output=p1.stdout, stderr=p1.stderr)
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, p.args, output=p.stdout, stderr=p.stderr)
 
-    # Otteniamo gli UUID per le ogni traccia
-    p2 = subprocess.run(
-        [sys.executable, os.path.join(BASE_DIR, "uuidfromname.py"), csv_1, csv_2],
-        check=False,
-        capture_output=True,
-        text=True,
-    )
-    if p2.returncode != 0:
-        raise subprocess.CalledProcessError(p2.returncode, p2.args, output=p2.stdout, stderr=p2.stderr)
+
+# Esegue la pipeline completa e ritorna il CSV finale con la scadenza aggiornata
+def run_pipeline(playlist_url: str, work_dir: str, deadline: Deadline = None):
+    deadline = deadline or Deadline()
+    
+    # Definiamo i percorsi dei file CSV temporanei (una cartella per richiesta,
+    # così richieste concorrenti non si sovrascrivono i CSV a vicenda)
+    csv_1 = os.path.join(work_dir, "playlist_tracks.csv")
+    csv_2 = os.path.join(work_dir, "playlist_with_uuid.csv")
+    csv_3 = os.path.join(work_dir, "playlist_with_features.csv")
+
+    # Otteniamo le tracce della playlist Spotify. Lo scraper restituisce la
+    # playlist intera in una sola chiamata, quindi separare lo step non ritarda
+    # la ricerca degli UUID e ci dà il numero di tracce per il budget.
+    scraped = scrape_playlist_to_csv(playlist_url, csv_1, deadline)
+    deadline = deadline.extended(TRACK_BUDGET * len(scraped))
+
+    # Otteniamo gli UUID delle tracce
+    run_script("uuidfromname.py", csv_1, csv_2, deadline=deadline.stage(STAGE_SHARES["uuid"]))
 
     # Otteniamo le feature audio per ogni traccia
-    p3 = subprocess.run(
-        [sys.executable, os.path.join(BASE_DIR, "soundcharts.py"), csv_2, csv_3],
-        check=False,
-        capture_output=True,
-        text=True,
-    )
-    if p3.returncode != 0:
-        raise subprocess.CalledProcessError(p3.returncode, p3.args, output=p3.stdout, stderr=p3.stderr)
+    run_script("soundcharts.py", csv_2, csv_3, deadline=deadline.stage(STAGE_SHARES["features"]))
+
+    return csv_3, deadline
 
-    return csv_3
+
+# Esegue la pipeline solo sulle tracce aggiunte rispetto allo stato salvato
+def run_incremental_pipeline(playlist_url: str, work_dir: str, state: dict, deadline: Deadline = None):
+    deadline = deadline or Deadline()
+    csv_1 = os.path.join(work_dir, "playlist_tracks.csv")
+    csv_added = os.path.join(work_dir, "playlist_added.csv")
+    csv_2 = os.path.join(work_dir, "playlist_with_uuid.csv")
+    csv_3 = os.path.join(work_dir, "playlist_with_features.csv")
+
+    # Scarichiamo la playlist attuale e la confrontiamo con lo stato
+    scraped = scrape_playlist_to_csv(playlist_url, csv_1, deadline)
+
+    added_rows, added_keys = diff_playlist(state, scraped)
+    new_tracks, new_skipped = [], []
+
+    # Risolviamo e classifichiamo solo le tracce nuove
+    if added_rows:
+        with open(csv_added, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=["title", "artist"])
+            writer.writeheader()
+            writer.writerows(added_rows)
+
+        deadline = deadline.extended(TRACK_BUDGET * len(added_rows))
+        run_script("uuidfromname.py", csv_added, csv_2, deadline=deadline.stage(STAGE_SHARES["uuid"]))
+        run_script("soundcharts.py", csv_2, csv_3, deadline=deadline.stage(STAGE_SHARES["features"]))
+
+        try:
+            df, _ = calculate_moods(csv_3, model, get_model_version())
+            new_tracks = df.to_dict(orient="records")
+        except ValueError as e:
+            print(f"[INCREMENTAL] {e}")
+        new_skipped = get_skipped_tracks(csv_3)
+
+    state, changed_moods, summary = apply_diff(state, scraped, added_keys, new_tracks, new_skipped)
+    if not state["tracks"]:
+        raise ValueError("Nessuna traccia disponibile per l'analisi del mood")
+
+    # Le raccomandazioni si ricalcolano solo per i mood la cui composizione è cambiata
+    if changed_moods:
+        kept = {
+            f"{rec['track']} - {rec['artist']}".lower()
+            for mood_id, mood_name in MOOD_LABELS.items()
+            if mood_id not in changed_moods and (rec := state["recommendations"].get(mood_name))
+        }
+        updated = recommend_for_moods(pd.DataFrame(state["tracks"]), sorted(changed_moods), LASTFM_API_KEY, kept, deadline)
+        state["recommendations"] = {**state["recommendations"], **updated}
+
+    summary["recomputed_moods"] = [MOOD_LABELS[m] for m in sorted(changed_moods)]
+    return state, summary
 
 # ==============================
 # API ENDPOINTS
@@ -113,30 +191,71 @@ def run_pipeline(playlist_url: str):
 @app.post("/process-playlist")
 
 # Esegue l'intera pipeline per una playlist Spotify
-def process_playlist(req: PlaylistRequest):
+def process_playlist(req: PlaylistRequest, request: Request):
+    work_dir = tempfile.mkdtemp(prefix="playmoodify_")
+    deadline = Deadline.after(REQUEST_BUDGET)
     try:
-        final_csv = run_pipeline(req.playlist_url)
-        df, overall = calculate_moods(final_csv, model)
-        similar_songs = get_similar_songs_by_mood(final_csv)
+        playlist_id = extract_playlist_id(req.playlist_url)
+        model_version = get_model_version()
+        state = load_state(playlist_id) if req.incremental else None
+
+        # Lo stato è riutilizzabile solo se calcolato con lo stesso modello
+        if state is not None and state.get("model_version") == model_version:
+            state, summary = run_incremental_pipeline(req.playlist_url, work_dir, state, deadline)
+            overall = overall_from_state(state)
+        else:
+            final_csv, deadline = run_pipeline(req.playlist_url, work_dir, deadline)
+            df, overall = calculate_moods(final_csv, model, model_version)
+            similar_songs = get_similar_songs_by_mood(final_csv, deadline=deadline)
+            state = build_state(df.to_dict(orient="records"), get_skipped_tracks(final_csv), similar_songs, model_version)
+            summary = {"added": len(state["tracks"]) + len(state["skipped"]), "removed": 0, "retried": 0,
+                       "recomputed_moods": list(MOOD_LABELS.values()), "full_run": True}
+
+        save_state(playlist_id, state)
 
         response_data = {
             "status": "success",
             "playlist_url": req.playlist_url,
             "overall_mood": overall,
-            "similar_songs_by_mood": similar_songs,
-            "tracks": df.to_dict(orient="records")
+            "similar_songs_by_mood": state["recommendations"],
+            "tracks": state["tracks"],
+            "skipped_tracks": state["skipped"]
         }
+        if req.incremental:
+            response_data["incremental"] = summary
+        response_data = compact_response(response_data, req.fields, req.layout, req.page, req.page_size)
         
-        cleanup_csv_files(BASE_DIR)
+        cleanup_work_dir(work_dir)
         
-        return response_data
+        return json_response(response_data, request.headers.get("accept-encoding"))
 
     except subprocess.CalledProcessError as e:
-        cleanup_csv_files(BASE_DIR)
+        cleanup_work_dir(work_dir)
         return {"status": "error", "error": f"Errore script: {str(e)}"}
 
+    except subprocess.TimeoutExpired as e:
+        cleanup_work_dir(work_dir)
+        return {"status": "error", "error": f"Timeout script: {str(e)}"}
+
     except Exception as e:
-        cleanup_csv_files(BASE_DIR)
+        cleanup_work_dir(work_dir)
         return {"status": "error", "error": str(e)}
 
 
+@app.get("/playlist-tracks")
+
+# Pagine successive delle tracce dall'ultima analisi salvata, senza rieseguire la pipeline
+def get_playlist_tracks(request: Request, playlist_url: str, page: int = 1, page_size: int = 100,
+                        fields: Optional[str] = None, layout: Literal["records", "columnar"] = "records"):
+    state = load_state(extract_playlist_id(playlist_url))
+    if state is None:
+        return {"status": "error", "error": "Playlist non ancora analizzata"}
+
+    page = max(page, 1)
+    page_size = min(max(page_size, 1), MAX_PAGE_SIZE)
+    response_data = compact_response(
+        {"status": "success", "playlist_url": playlist_url, "tracks": state["tracks"], "skipped_tracks": state["skipped"]},
+        [f for f in fields.split(",") if f] if fields else None,
+        layout, page, page_size
+    )
+    return json_response(response_data, request.headers.get("accept-encoding"))
@@ -0,0 +1,243 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from mood_analysis import FEATURE_COLUMNS, calculate_moods, uncertain_tracks_from_proba
+from feature_validation import predict_moods, predict_is_proba_argmax
+
+# ==============================
+# BENCHMARK PREDICT VS PREDICT_PROBA
+# ==============================
+#
+# Confronta il vecchio percorso (solo model.predict + value_counts) con quello
+# probabilistico (predict_proba + confidenza, distribuzione pesata e tracce
+# incerte) su playlist grandi, sia a livello di modello sia per l'intera
+# calculate_moods. Per gli alberi (RandomForest) predict è già l'argmax di
+# predict_proba e basta una chiamata al modello; per LogisticRegression servono
+# predict e predict_proba, pochi ms su 10k tracce. Il verdetto
+# guarda calculate_moods completa, cioè il costo pagato da una richiesta.
+#
+# Verifica anche, sul modello di produzione (--model-path o HuggingFace), se le
+# etichette di predict coincidono con l'argmax di predict_proba: predict_moods
+# salta model.predict solo per gli stimatori dove vale per costruzione.
+#
+# Esempio:
+#   python bench_mood_proba.py --sizes 1000,10000,100000 --trees 200
+#   python bench_mood_proba.py --sizes 1000 --model-path PlayMoodify.pkl
+
+
+# Nasconde predict_proba: calculate_moods ripiega sul percorso con le sole etichette
+class PredictOnly:
+    def __init__(self, model):
+        self.model = model
+
+    def predict(self, X):
+        return self.model.predict(X)
+
+
+def build_models(trees: int) -> Dict[str, object]:
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.linear_model import LogisticRegression
+
+    rng = np.random.default_rng(0)
+    X = pd.DataFrame(rng.random((5000, len(FEATURE_COLUMNS))), columns=FEATURE_COLUMNS)
+    X["tempo"] *= 200
+    y = (X["valence"] >= 0.5).astype(int) + 2 * (X["energy"] >= 0.5).astype(int)
+
+    return {
+        f"random_forest({trees})": RandomForestClassifier(n_estimators=trees, random_state=0, n_jobs=1).fit(X, y),
+        "logistic_regression": LogisticRegression(max_iter=1000).fit(X, y),
+    }
+
+
+# Modello di produzione da MODEL_PATH/--model-path o da HuggingFace; None se non disponibile
+def load_production_model(model_path: Optional[str]):
+    try:
+        if model_path:
+            import joblib
+            return joblib.load(model_path)
+        from utils import load_model
+        return load_model()
+    except Exception as e:
+        print(f"[BENCH] ⚠️ Modello di produzione non disponibile, controllo etichette saltato: {e}", flush=True)
+        return None
+
+
+# Modello dove predict e argmax di predict_proba possono divergere (Platt scaling)
+def build_svc():
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+    from sklearn.svm import SVC
+
+    rng = np.random.default_rng(2)
+    X = pd.DataFrame(rng.random((1000, len(FEATURE_COLUMNS))), columns=FEATURE_COLUMNS)
+    X["tempo"] *= 200
+    y = (X["valence"] + 0.3 * rng.standard_normal(len(X)) >= 0.5).astype(int) \
+        + 2 * (X["energy"] + 0.3 * rng.standard_normal(len(X)) >= 0.5).astype(int)
+    return make_pipeline(StandardScaler(), SVC(probability=True, random_state=0)).fit(X, y)
+
+
+# Quota di tracce in cui model.predict coincide con l'argmax di predict_proba
+def label_agreement(models: Dict[str, object], n: int) -> List[Dict]:
+    X = make_playlist(n, seed=3)[FEATURE_COLUMNS]
+    results = []
+    for name, model in models.items():
+        predicted = np.asarray(model.predict(X)).astype(int)
+        argmax = np.asarray(model.classes_)[model.predict_proba(X).argmax(axis=1)].astype(int)
+        results.append({
+            "model": name,
+            "agreement": float((predicted == argmax).mean()),
+            "shortcut": predict_is_proba_argmax(model),
+        })
+    return results
+
+
+def make_playlist(n: int, seed: int = 1) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(rng.random((n, len(FEATURE_COLUMNS))), columns=FEATURE_COLUMNS)
+    df["tempo"] *= 200
+    df.insert(0, "status", "resolved")
+    df.insert(0, "uuid", [f"u{i}" for i in range(n)])
+    df.insert(0, "artist", "Artist")
+    df.insert(0, "title", [f"Track {i}" for i in range(n)])
+    df.insert(0, "position", np.arange(1, n + 1))
+    return df
+
+
+# Misura due funzioni alternandole, così il rumore della macchina pesa su entrambe.
+# Ritorna il tempo migliore di ciascuna e la mediana dei rapporti b/a delle
+# coppie consecutive, che resta stabile anche se la macchina rallenta a tratti.
+def paired_times(fn_a: Callable, fn_b: Callable, repeats: int) -> Tuple[float, float, float]:
+    times_a, times_b = [], []
+    fn_a(), fn_b()
+    for _ in range(repeats):
+        for fn, times in ((fn_a, times_a), (fn_b, times_b)):
+            start = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - start)
+    ratio = float(np.median(np.array(times_b) / np.array(times_a)))
+    return min(times_a), min(times_b), ratio
+
+
+# Percorso precedente: etichette e conteggi
+def labels_path(model, X: pd.DataFrame):
+    labels = pd.Series(model.predict(X).astype(int))
+    return int(labels.mode()[0]), labels.value_counts(normalize=True).to_dict()
+
+
+# Percorso probabilistico: stesse statistiche più confidenza, distribuzione pesata e tracce incerte
+def proba_path(model, X: pd.DataFrame, df: pd.DataFrame):
+    labels, proba = predict_moods(model, X)
+    labels = pd.Series(labels, index=df.index)
+    return (
+        int(labels.mode()[0]),
+        labels.value_counts(normalize=True).to_dict(),
+        proba.max(axis=1),
+        proba.mean(axis=0),
+        uncertain_tracks_from_proba(df, proba),
+    )
+
+
+def run(models: Dict[str, object], sizes: List[int], repeats: int) -> List[Dict]:
+    results = []
+    work_dir = tempfile.mkdtemp(prefix="playmoodify_bench_")
+
+    for name, model in models.items():
+        for n in sizes:
+            df = make_playlist(n)
+            X = df[FEATURE_COLUMNS]
+
+            predict_s, proba_s, ratio = paired_times(
+                lambda: labels_path(model, X), lambda: proba_path(model, X, df), repeats
+            )
+
+            # calculate_moods completa (lettura CSV, validazione, scrittura) con i due percorsi
+            csv_path = os.path.join(work_dir, f"playlist_{n}.csv")
+
+            def end_to_end(m):
+                df.to_csv(csv_path, index=False)
+                calculate_moods(csv_path, m)
+
+            e2e_predict_s, e2e_proba_s, e2e_ratio = paired_times(
+                lambda: end_to_end(PredictOnly(model)), lambda: end_to_end(model), repeats
+            )
+
+            results.append({
+                "model": name,
+                "tracks": n,
+                "predict_ms": predict_s * 1000,
+                "proba_ms": proba_s * 1000,
+                "ratio": ratio,
+                "e2e_predict_ms": e2e_predict_s * 1000,
+                "e2e_proba_ms": e2e_proba_s * 1000,
+                "e2e_ratio": e2e_ratio,
+            })
+            print(f"[BENCH] {name} {n} tracce: predict {predict_s * 1000:.1f} ms, "
+                  f"proba {proba_s * 1000:.1f} ms", flush=True)
+
+    return results
+
+
+def print_report(results: List[Dict], tolerance: float) -> bool:
+    header = (f"{'model':>22} {'tracks':>7} {'predict':>9} {'proba':>9} {'ratio':>6} "
+              f"{'e2e_pred':>9} {'e2e_prob':>9} {'ratio':>6}")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['model']:>22} {r['tracks']:>7} {r['predict_ms']:>9.1f} {r['proba_ms']:>9.1f} {r['ratio']:>6.2f} "
+              f"{r['e2e_predict_ms']:>9.1f} {r['e2e_proba_ms']:>9.1f} {r['e2e_ratio']:>6.2f}")
+
+    # Il verdetto guarda calculate_moods completa: è il costo che paga una richiesta
+    ok = all(r["e2e_ratio"] <= 1 + tolerance for r in results)
+    print(f"\nTempi in ms (migliore di più ripetizioni), ratio = mediana dei rapporti tra coppie. calculate_moods con probabilità entro "
+          f"{tolerance:.0%} dal solo predict: {'SÌ' if ok else 'NO'}")
+    return ok
+
+
+# Il salto di predict è corretto solo se dove viene usato le etichette coincidono sempre
+def print_agreement(results: List[Dict]) -> bool:
+    print(f"{'model':>22} {'agreement':>10} {'shortcut':>9}")
+    for r in results:
+        print(f"{r['model']:>22} {r['agreement']:>10.2%} {'sì' if r['shortcut'] else 'no':>9}")
+    ok = all(r["agreement"] == 1.0 for r in results if r["shortcut"])
+    print(f"\nagreement = tracce con predict == argmax(predict_proba); shortcut = predict_moods "
+          f"usa l'argmax al posto di predict. Shortcut sempre coerente: {'SÌ' if ok else 'NO'}")
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark predict vs predict_proba su playlist grandi")
+    parser.add_argument("--sizes", default="1000,10000,100000")
+    parser.add_argument("--trees", type=int, default=200)
+    parser.add_argument("--repeats", type=int, default=7)
+    parser.add_argument("--tolerance", type=float, default=0.10, help="sovracosto massimo ammesso")
+    parser.add_argument("--model-path", default=os.environ.get("MODEL_PATH"),
+                        help="modello di produzione per il controllo delle etichette (default: HuggingFace)")
+    parser.add_argument("--agreement-tracks", type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    models = build_models(args.trees)
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    results = run(models, sizes, args.repeats)
+
+    checked = dict(models, svc_probability=build_svc())
+    production = load_production_model(args.model_path)
+    if production is not None and hasattr(production, "predict_proba") and hasattr(production, "classes_"):
+        checked["production"] = production
+    agreement = label_agreement(checked, args.agreement_tracks)
+
+    print()
+    fast = print_report(results, args.tolerance)
+    print()
+    consistent = print_agreement(agreement)
+    return 0 if fast and consistent else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+import argparse
+import gzip
+import sys
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+from mood_analysis import FEATURE_COLUMNS, PROBABILITY_PREFIX
+from response_format import (
+    CLIENT_TRACK_FIELDS, GZIP_LEVEL, BROTLI_QUALITY,
+    brotli, compact_response, encode_json
+)
+
+# ==============================
+# BENCHMARK RISPOSTA /process-playlist
+# ==============================
+#
+# Misura tempo di serializzazione e byte trasmessi della risposta di una
+# playlist grande, confrontando la risposta completa (come la serializza
+# FastAPI restituendo un dict) con le modalità compatte: campi scelti dal
+# client, layout colonnare, paginazione e compressione gzip/brotli.
+#
+# Esempio:
+#   python bench_response.py --sizes 1000,10000
+
+
+# Tracce sintetiche con le stesse colonne dello stato salvato di una playlist
+def make_response(n: int, seed: int = 0) -> Dict:
+    rng = np.random.default_rng(seed)
+    features = rng.random((n, len(FEATURE_COLUMNS)))
+    proba = rng.dirichlet(np.ones(4), size=n)
+
+    tracks = []
+    for i in range(n):
+        track = {
+            "position": i + 1,
+            "title": f"Track number {i} (Remastered {1990 + i % 30})",
+            "artist": f"Artist {i % 97}, Featured {i % 13}",
+            "uuid": f"{i:08x}-5e1f-4c1a-9d2b-{i * 7919 % 16 ** 12:012x}",
+            "status": "resolved",
+            "match_source": "remote" if i % 3 else "local",
+            "match_score": round(0.9 + (i % 10) / 100, 3),
+        }
+        for j, name in enumerate(FEATURE_COLUMNS):
+            track[name] = float(features[i, j] * (200 if name == "tempo" else 1))
+        track["label"] = int(proba[i].argmax())
+        track["imputed"] = bool(i % 50 == 0)
+        track["imputed_features"] = "tempo" if i % 50 == 0 else ""
+        track["confidence"] = float(proba[i].max())
+        for c in range(4):
+            track[f"{PROBABILITY_PREFIX}{c}"] = float(proba[i, c])
+        tracks.append(track)
+
+    return {
+        "status": "success",
+        "playlist_url": "https://open.spotify.com/playlist/bench",
+        "overall_mood": {"mood_mode": 1, "total_tracks": n},
+        "similar_songs_by_mood": {},
+        "tracks": tracks,
+        "skipped_tracks": [{"position": n + 1, "title": "Missing", "artist": "Nobody", "status": "N/A"}]
+    }
+
+
+# Percorso attuale: FastAPI converte il dict con jsonable_encoder e poi JSONResponse
+def default_body(payload: Dict) -> bytes:
+    return JSONResponse(content=jsonable_encoder(payload)).body
+
+
+def best_time(fn: Callable, repeats: int):
+    best, result = None, None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def variants() -> Dict[str, Callable[[Dict], Dict]]:
+    return {
+        "records, tutti i campi": lambda r: compact_response(r),
+        "records, campi client": lambda r: compact_response(r, CLIENT_TRACK_FIELDS),
+        "colonnare, tutti i campi": lambda r: compact_response(r, layout="columnar"),
+        "colonnare, campi client": lambda r: compact_response(r, CLIENT_TRACK_FIELDS, "columnar"),
+        "pagina da 100, campi client": lambda r: compact_response(r, CLIENT_TRACK_FIELDS, page_size=100),
+    }
+
+
+def encodings() -> Dict[str, Callable[[bytes], bytes]]:
+    result = {
+        "identity": lambda body: body,
+        "gzip": lambda body: gzip.compress(body, compresslevel=GZIP_LEVEL),
+    }
+    if brotli is not None:
+        result["br"] = lambda body: brotli.compress(body, quality=BROTLI_QUALITY)
+    return result
+
+
+def run(sizes: List[int], repeats: int) -> List[Dict]:
+    results = []
+    for n in sizes:
+        payload = make_response(n)
+        print(f"[BENCH] {n} tracce...", flush=True)
+
+        encode_s, body = best_time(lambda: default_body(payload), repeats)
+        baseline_bytes = len(body)
+        results.append({"tracks": n, "mode": "attuale (dict FastAPI)", "encoding": "identity",
+                        "ms": encode_s * 1000, "bytes": baseline_bytes})
+
+        for name, build in variants().items():
+            encode_s, body = best_time(lambda: encode_json(build(payload)), repeats)
+            for encoding, fn in encodings().items():
+                compress_s, compressed = best_time(lambda: fn(body), repeats)
+                results.append({"tracks": n, "mode": name, "encoding": encoding,
+                                "ms": (encode_s + compress_s) * 1000, "bytes": len(compressed)})
+
+        for r in results:
+            if r["tracks"] == n:
+                r["ratio"] = r["bytes"] / baseline_bytes
+    return results
+
+
+def print_report(results: List[Dict]):
+    header = f"{'tracks':>7} {'modalità':>28} {'enc':>9} {'ms':>9} {'KB':>10} {'byte/attuale':>13}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['tracks']:>7} {r['mode']:>28} {r['encoding']:>9} {r['ms']:>9.1f} "
+              f"{r['bytes'] / 1024:>10.1f} {r['ratio']:>13.3f}")
+    print("\nms = serializzazione (+ compressione), migliore di più ripetizioni")
+    if brotli is None:
+        print("brotli non installato: solo gzip")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark di serializzazione e dimensione della risposta")
+    parser.add_argument("--sizes", default="1000,10000")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    results = run([int(s) for s in args.sizes.split(",") if s.strip()], args.repeats)
+    print()
+    print_report(results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,281 @@
+import argparse
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List
+
+import requests
+
+from loadtest import (
+    BACKEND_DIR, LoadGenerator, StubModel,
+    configure_stub_environment, start_stub_upstream
+)
+
+# ==============================
+# BENCHMARK MULTI-WORKER
+# ==============================
+#
+# Avvia gunicorn (gunicorn.conf.py) con 1..N worker, con e senza preload del
+# modello, contro gli stub di loadtest.py. Per ogni configurazione misura RSS,
+# PSS e memoria privata di ogni worker (da /proc/<pid>/smaps_rollup) e il
+# throughput di /process-playlist.
+#
+# Gli step uuidfromname.py e soundcharts.py girano in sottoprocessi avviati dai
+# worker durante le richieste: non condividono pagine con il master, quindi la
+# loro memoria viene campionata a parte durante il carico (picco per processo e
+# picco complessivo dei sottoprocessi attivi nello stesso momento).
+#
+# Il PSS divide le pagine condivise tra i processi che le usano: con il preload
+# il modello pesa una volta sola sul totale, senza preload una volta per worker.
+#
+# Esempio:
+#   python bench_workers.py --workers 1,2,4 --requests 40 --model-trees 300
+
+
+# Modello di prova: regole deterministiche di loadtest più un RandomForest come zavorra
+def build_model(path: str, trees: int, samples: int):
+    import joblib
+    import numpy as np
+    from sklearn.ensemble import RandomForestClassifier
+
+    rng = np.random.default_rng(0)
+    X = rng.random((samples, 8))
+    y = (X[:, 6] >= 0.5).astype(int) + 2 * (X[:, 1] >= 0.5).astype(int)
+    forest = RandomForestClassifier(n_estimators=trees, random_state=0).fit(X, y)
+    joblib.dump(StubModel(ballast=forest), path)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(workers: int, preload: bool, port: int, model_path: str) -> subprocess.Popen:
+    env = os.environ.copy()
+    env.update({
+        "MODEL_PATH": model_path,
+        "WEB_CONCURRENCY": str(workers),
+        "PRELOAD_APP": "1" if preload else "0",
+        "BIND": f"127.0.0.1:{port}",
+    })
+    return subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app:app"],
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+# Figli di un processo: ogni thread ha la sua lista, e i sottoprocessi della
+# pipeline vengono avviati dai thread delle richieste, non dal thread principale
+def child_pids(pid: int) -> List[int]:
+    pids = []
+    try:
+        tasks = os.listdir(f"/proc/{pid}/task")
+    except OSError:
+        return []
+    for task in tasks:
+        try:
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                pids.extend(int(p) for p in f.read().split())
+        except OSError:
+            continue
+    return pids
+
+
+def wait_ready(url: str, master: subprocess.Popen, workers: int, timeout: float = 120):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if master.poll() is not None:
+            raise RuntimeError("gunicorn è terminato durante l'avvio")
+        try:
+            if requests.get(f"{url}/openapi.json", timeout=2).status_code == 200 \
+                    and len(child_pids(master.pid)) >= workers:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("gunicorn non è pronto")
+
+
+def descendant_pids(pid: int) -> List[int]:
+    pids = []
+    for child in child_pids(pid):
+        pids.append(child)
+        pids.extend(descendant_pids(child))
+    return pids
+
+
+# Memoria di un processo in MB: rss, pss e privata (pagine non condivise)
+def memory_mb(pid: int) -> Dict[str, float]:
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(":") and parts[1].isdigit():
+                values[parts[0][:-1]] = int(parts[1]) / 1024
+    return {
+        "rss": values.get("Rss", 0.0),
+        "pss": values.get("Pss", 0.0),
+        "private": values.get("Private_Clean", 0.0) + values.get("Private_Dirty", 0.0),
+    }
+
+
+PIPELINE_SCRIPTS = ("uuidfromname.py", "soundcharts.py")
+
+
+def is_pipeline_step(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            args = f.read().decode(errors="replace").split("\0")
+    except OSError:
+        return False
+    return any(os.path.basename(a) in PIPELINE_SCRIPTS for a in args)
+
+
+# Campiona in background la memoria dei sottoprocessi della pipeline avviati dai
+# worker (solo dopo l'exec dello script: prima il figlio è ancora una copia del worker)
+class SubprocessSampler:
+    def __init__(self, worker_pids: List[int], interval: float = 0.05):
+        self.worker_pids = worker_pids
+        self.interval = interval
+        self.peak_rss = 0.0
+        self.peak_total_pss = 0.0
+        self.processes = set()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            total_pss = 0.0
+            for worker in self.worker_pids:
+                for pid in descendant_pids(worker):
+                    if not is_pipeline_step(pid):
+                        continue
+                    try:
+                        memory = memory_mb(pid)
+                    except OSError:
+                        # Il sottoprocesso è terminato tra la lista e la lettura
+                        continue
+                    self.processes.add(pid)
+                    self.peak_rss = max(self.peak_rss, memory["rss"])
+                    total_pss += memory["pss"]
+            self.peak_total_pss = max(self.peak_total_pss, total_pss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_config(workers: int, preload: bool, model_path: str, stub_url: str,
+               total_requests: int, tracks: int) -> Dict:
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    master = start_gunicorn(workers, preload, port, model_path)
+
+    try:
+        wait_ready(url, master, workers)
+        generator = LoadGenerator(url, stub_url, tracks, image_ratio=0.0, timeout=300)
+
+        # Riscaldamento: ogni worker carica i moduli e apre le connessioni
+        generator.run_level(workers, workers)
+        worker_pids = child_pids(master.pid)
+        with SubprocessSampler(worker_pids) as sampler:
+            level = generator.run_level(workers * 2, total_requests)
+
+        worker_memory = [memory_mb(pid) for pid in worker_pids]
+        master_memory = memory_mb(master.pid)
+    finally:
+        master.send_signal(signal.SIGTERM)
+        try:
+            master.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            master.kill()
+
+    def avg(key):
+        return sum(m[key] for m in worker_memory) / len(worker_memory) if worker_memory else 0.0
+
+    return {
+        "mode": "preload" if preload else "no-preload",
+        "workers": workers,
+        "master_rss_mb": master_memory["rss"],
+        "worker_rss_mb": avg("rss"),
+        "worker_pss_mb": avg("pss"),
+        "worker_private_mb": avg("private"),
+        "total_pss_mb": master_memory["pss"] + sum(m["pss"] for m in worker_memory),
+        "subprocess_rss_mb": sampler.peak_rss,
+        "subprocess_total_pss_mb": sampler.peak_total_pss,
+        "subprocesses": len(sampler.processes),
+        "throughput_rps": level["throughput_rps"],
+        "p99_ms": level["p99_ms"],
+        "errors": level["errors"],
+        "corrupt": level["corrupt"],
+    }
+
+
+def print_report(results: List[Dict]):
+    header = (f"{'mode':>11} {'wrk':>4} {'masterRSS':>10} {'wRSS':>8} {'wPSS':>8} {'wPriv':>8} "
+              f"{'totPSS':>8} {'subRSS':>8} {'subPSS':>8} {'rps':>7} {'scale':>6} {'p99ms':>8} {'err':>4} {'corr':>5}")
+    print(header)
+    print("-" * len(header))
+
+    baseline = {}
+    for r in results:
+        baseline.setdefault(r["mode"], r["throughput_rps"])
+        scale = r["throughput_rps"] / baseline[r["mode"]] if baseline[r["mode"]] else 0.0
+        print(f"{r['mode']:>11} {r['workers']:>4} {r['master_rss_mb']:>10.1f} {r['worker_rss_mb']:>8.1f} "
+              f"{r['worker_pss_mb']:>8.1f} {r['worker_private_mb']:>8.1f} {r['total_pss_mb']:>8.1f} "
+              f"{r['subprocess_rss_mb']:>8.1f} {r['subprocess_total_pss_mb']:>8.1f} {r['throughput_rps']:>7.2f} {scale:>6.2f} {r['p99_ms']:>8.1f} {r['errors']:>4} {r['corrupt']:>5}")
+    print("\nMemoria in MB; scale = throughput rispetto a 1 worker nella stessa modalità")
+    print("subRSS = picco RSS di un sottoprocesso della pipeline, subPSS = picco PSS dei sottoprocessi attivi insieme")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark di memoria e throughput multi-worker")
+    parser.add_argument("--workers", default="1,2,4", help="numero di worker da provare")
+    parser.add_argument("--modes", default="preload,no-preload")
+    parser.add_argument("--requests", type=int, default=40, help="richieste misurate per configurazione")
+    parser.add_argument("--tracks", type=int, default=20)
+    parser.add_argument("--upstream-latency", type=float, default=20.0, help="latenza degli stub in ms")
+    parser.add_argument("--model-trees", type=int, default=300)
+    parser.add_argument("--model-samples", type=int, default=20000)
+    args = parser.parse_args(argv)
+
+    stub = start_stub_upstream(args.upstream_latency / 1000, 0.0)
+    stub_url = f"http://127.0.0.1:{stub.server_address[1]}"
+    stub_dir = configure_stub_environment(stub_url)
+
+    # I worker devono poter importare StubModel per caricare il modello
+    os.environ["PYTHONPATH"] = os.pathsep.join([BACKEND_DIR, os.environ["PYTHONPATH"]])
+
+    model_path = os.path.join(stub_dir, "model.pkl")
+    print(f"[BENCH] Addestramento modello di prova ({args.model_trees} alberi)...", flush=True)
+    build_model(model_path, args.model_trees, args.model_samples)
+    print(f"[BENCH] Modello: {os.path.getsize(model_path) / 1024 / 1024:.1f} MB su disco", flush=True)
+
+    results = []
+    for mode in [m.strip() for m in args.modes.split(",") if m.strip()]:
+        for workers in [int(w) for w in args.workers.split(",") if w.strip()]:
+            print(f"[BENCH] {mode}, {workers} worker...", flush=True)
+            results.append(run_config(
+                workers, mode == "preload", model_path, stub_url, args.requests, args.tracks
+            ))
+
+    print()
+    print_report(results)
+    return 1 if any(r["corrupt"] for r in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
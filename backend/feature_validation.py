@@ -0,0 +1,199 @@
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from shared_cache import SharedCache
+
+# ==============================
+# RANGE DELLE FEATURE
+# ==============================
+
+# Intervalli validi delle feature audio SoundCharts (stessa scala di Spotify)
+FEATURE_RANGES = {
+    "danceability": (0.0, 1.0),
+    "energy": (0.0, 1.0),
+    "speechiness": (0.0, 1.0),
+    "acousticness": (0.0, 1.0),
+    "instrumentalness": (0.0, 1.0),
+    "liveness": (0.0, 1.0),
+    "valence": (0.0, 1.0),
+    "tempo": (0.0, 250.0)
+}
+
+# Sotto questo numero di feature osservate una traccia non viene classificata:
+# il risultato dipenderebbe più dai prior che dalla canzone
+MIN_OBSERVED_FEATURES = 5
+
+# Prior di riserva, usati solo finché non ci sono abbastanza tracce osservate per
+# calcolarli dai dati (vedi get_feature_priors). Non sono misurati: sono valori
+# scelti a mano come centro plausibile di ogni feature per musica pop recente
+# (instrumentalness quasi sempre 0, tempo intorno ai 120 BPM) e non hanno prior per mood.
+DEFAULT_FEATURE_PRIORS = {
+    "source": "default",
+    "global": {
+        "danceability": 0.58,
+        "energy": 0.63,
+        "speechiness": 0.05,
+        "acousticness": 0.2,
+        "instrumentalness": 0.0,
+        "liveness": 0.13,
+        "valence": 0.48,
+        "tempo": 120.0
+    },
+    "by_mood": {}
+}
+
+# Feature SoundCharts già scaricate dalla pipeline (stessa cache di soundcharts.py)
+_features_cache = SharedCache("features", ttl=30 * 24 * 3600)
+
+# Prior calcolati dalle feature osservate: quante tracce leggere, quante ne
+# servono come minimo e ogni quanto ricalcolarli in ogni processo
+OBSERVED_PRIORS_SAMPLE = 5000
+OBSERVED_PRIORS_MIN_TRACKS = 200
+OBSERVED_PRIORS_TTL = 3600
+
+_observed_priors = None  # (id del modello, istante del calcolo, prior o None)
+_observed_priors_lock = threading.Lock()
+
+# ==============================
+# PRIOR DEL MODELLO
+# ==============================
+
+# Prior nell'ordine: quelli salvati sul modello come `feature_priors_` (vedi
+# build_feature_priors), poi quelli calcolati dalle feature SoundCharts già
+# osservate, infine DEFAULT_FEATURE_PRIORS. Il modello pubblicato su HuggingFace
+# non ha `feature_priors_`, quindi in produzione valgono i prior osservati.
+def get_feature_priors(model) -> Dict:
+    priors = getattr(model, "feature_priors_", None)
+    if priors and "global" in priors:
+        return priors
+    return get_observed_priors(model) or DEFAULT_FEATURE_PRIORS
+
+
+# Mediane globali e per mood (stimato dal modello) delle tracce complete in cache
+def get_observed_priors(model) -> Optional[Dict]:
+    global _observed_priors
+    with _observed_priors_lock:
+        cached = _observed_priors
+        if cached is not None and cached[0] == id(model) and time.time() - cached[1] < OBSERVED_PRIORS_TTL:
+            return cached[2]
+
+        priors = None
+        try:
+            values = [v for v in _features_cache.recent_values(OBSERVED_PRIORS_SAMPLE) if isinstance(v, dict)]
+            X, missing = validate_features(pd.DataFrame(values))
+            X = X[~missing.any(axis=1)]
+            if len(X) >= OBSERVED_PRIORS_MIN_TRACKS:
+                observed = X.assign(label=np.asarray(model.predict(X)).astype(int))
+                priors = dict(build_feature_priors(observed), source="observed", tracks=int(len(X)))
+                print(f"[MOOD] Prior delle feature calcolati da {len(X)} tracce osservate")
+        except Exception as e:
+            print(f"[MOOD] ⚠️ Prior osservati non disponibili, uso quelli di riserva: {e}")
+
+        _observed_priors = (id(model), time.time(), priors)
+        return priors
+
+
+# Calcola i prior (mediane globali e per mood) da un dataset etichettato
+def build_feature_priors(df: pd.DataFrame, label_column: str = "label") -> Dict:
+    features = list(FEATURE_RANGES)
+    return {
+        "global": df[features].median().to_dict(),
+        "by_mood": {
+            int(label): group[features].median().to_dict()
+            for label, group in df.groupby(label_column)
+        }
+    }
+
+# ==============================
+# VALIDAZIONE E IMPUTAZIONE
+# ==============================
+
+# Converte le feature in numeri e scarta i valori fuori range.
+# Ritorna la matrice delle feature e la maschera dei valori mancanti o non validi.
+def validate_features(df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    features = list(FEATURE_RANGES)
+    X = pd.DataFrame(index=df.index, columns=features, dtype=float)
+
+    for name, (low, high) in FEATURE_RANGES.items():
+        if name not in df.columns:
+            continue
+        values = pd.to_numeric(df[name], errors="coerce")
+        X[name] = values.where(values.between(low, high))
+
+    return X, X.isna()
+
+
+# Sostituisce i valori mancanti con i prior globali o, se indicato il mood
+# di ogni traccia, con i prior di quel mood
+def impute_features(X: pd.DataFrame, missing: pd.DataFrame, priors: Dict,
+                    moods: Optional[np.ndarray] = None) -> pd.DataFrame:
+    global_prior = pd.Series(priors["global"])[X.columns]
+    fill = pd.DataFrame(
+        np.tile(global_prior.to_numpy(dtype=float), (len(X), 1)),
+        index=X.index,
+        columns=X.columns
+    )
+
+    by_mood = priors.get("by_mood") or {}
+    if moods is not None and by_mood:
+        for mood, mood_prior in by_mood.items():
+            rows = moods == int(mood)
+            if rows.any():
+                fill.loc[rows] = pd.Series(mood_prior)[X.columns].to_numpy(dtype=float)
+
+    return X.mask(missing, fill)
+
+
+# True se predict del modello è per costruzione l'argmax di predict_proba (foreste
+# sklearn, anche come ultimo passo di una Pipeline). Per altri stimatori non vale:
+# SVC(probability=True) decide con la funzione di decisione, non con Platt.
+def predict_is_proba_argmax(model) -> bool:
+    from sklearn.ensemble import ExtraTreesClassifier, RandomForestClassifier
+
+    final = model.steps[-1][1] if hasattr(model, "steps") else model
+    return isinstance(final, (RandomForestClassifier, ExtraTreesClassifier)) \
+        and type(final).predict is RandomForestClassifier.predict
+
+
+# Predice il mood e, se il modello lo supporta, le probabilità per classe.
+# Le etichette vengono sempre da model.predict, tranne quando coincide per
+# costruzione con l'argmax di predict_proba: lì basta una sola chiamata.
+def predict_moods(model, X: pd.DataFrame) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    if not (hasattr(model, "predict_proba") and hasattr(model, "classes_")):
+        return np.asarray(model.predict(X)).astype(int), None
+
+    proba = np.asarray(model.predict_proba(X), dtype=float)
+    if predict_is_proba_argmax(model):
+        labels = np.asarray(model.classes_)[proba.argmax(axis=1)]
+    else:
+        labels = np.asarray(model.predict(X))
+    return labels.astype(int), proba
+
+
+# Valida e imputa le feature, poi predice il mood. Con prior per mood le tracce
+# imputate vengono ripredette usando i prior del mood stimato al primo passaggio.
+# Ritorna etichette, feature imputate e probabilità (None se non disponibili).
+def predict_with_imputation(model, X: pd.DataFrame, missing: pd.DataFrame) -> Tuple[np.ndarray, pd.DataFrame, Optional[np.ndarray]]:
+    # Nessun valore mancante: i prior non servono
+    if not missing.to_numpy().any():
+        labels, proba = predict_moods(model, X)
+        return labels, X, proba
+
+    priors = get_feature_priors(model)
+    X_imputed = impute_features(X, missing, priors)
+    labels, proba = predict_moods(model, X_imputed)
+
+    imputed_rows = missing.any(axis=1).to_numpy()
+    if priors.get("by_mood") and imputed_rows.any():
+        X_refined = impute_features(X, missing, priors, moods=labels)
+        X_imputed.loc[imputed_rows] = X_refined.loc[imputed_rows]
+        refined_labels, refined_proba = predict_moods(model, X_imputed.loc[imputed_rows])
+        labels[imputed_rows] = refined_labels
+        if proba is not None:
+            proba[imputed_rows] = refined_proba
+
+    return labels, X_imputed, proba
@@ -0,0 +1,29 @@
+import gc
+import multiprocessing
+import os
+
+# ==============================
+# MODALITÀ MULTI-WORKER
+# ==============================
+#
+# Avvio: gunicorn -c gunicorn.conf.py app:app  (dalla cartella backend)
+#
+# Con preload_app l'app (e quindi il modello) viene importata una sola volta nel
+# master; i worker la ereditano con il fork e condividono le pagine di memoria
+# copy-on-write. Le cache (UUID, feature, etichette) sono su SQLite in WAL,
+# quindi ogni worker beneficia delle ricerche fatte dagli altri.
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count()))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = os.getenv("PRELOAD_APP", "1") != "0"
+timeout = int(os.getenv("WORKER_TIMEOUT", "120"))
+
+
+# Chiamato nel master dopo il preload e prima del fork dei worker
+def when_ready(server):
+    if preload_app:
+        # Spostiamo gli oggetti già caricati nella generazione permanente: il GC
+        # dei worker non ne toccherà gli header, evitando copie delle pagine condivise
+        gc.collect()
+        gc.freeze()
@@ -1,49 +1,233 @@
 import csv
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import requests
 from spotify_scraper import SpotifyClient
 
+from shared_cache import SharedCache
+from resilience import Deadline, DeadlineExceeded
 
-def spotify_playlist_to_csv(playlist_url, output_csv_path):
-    client = SpotifyClient()
-    playlist = client.get_playlist_info(playlist_url)
+SPOTIFY_WEB_URL = os.getenv("SPOTIFY_WEB_URL", "https://open.spotify.com")
 
-    tracks = []
+# Tracce emesse per pagina: la ricerca degli UUID può partire dopo la prima
+PAGE_SIZE = 100
 
-    for track in playlist.get("tracks", []):
+# Entro il TTL la playlist in cache si usa senza contattare Spotify,
+# dopo va rivalidata con una richiesta condizionale
+PLAYLIST_CACHE_TTL = int(os.getenv("PLAYLIST_CACHE_TTL", "600"))
 
-        # Skippiamo elementi non musicali o incompleti
-        if not track.get("artists") or not track.get("name"):
-            continue
+_playlist_cache = SharedCache("spotify_playlist")
+
+# ==============================
+# CLIENT SPOTIFY (UNO PER PROCESSO)
+# ==============================
+
+# Lo scraping gira nel worker dell'API (vedi scrape_playlist_to_csv), quindi
+# client e sessione vengono riusati da tutte le richieste del worker
+SPOTIFY_TIMEOUT = float(os.getenv("SPOTIFY_TIMEOUT", "10"))
+
+_client = None
+_session = None
+_client_lock = threading.Lock()
+
+
+def get_spotify_client() -> SpotifyClient:
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = SpotifyClient(timeout=SPOTIFY_TIMEOUT)
+    return _client
+
+
+def get_http_session() -> requests.Session:
+    global _session
+    if _session is None:
+        with _client_lock:
+            if _session is None:
+                _session = requests.Session()
+    return _session
+
+# ==============================
+# PLAYLIST METADATA
+# ==============================
+
+def extract_playlist_id(playlist_url: str) -> str:
+    return playlist_url.rstrip("/").split("/")[-1].split("?")[0]
+
+
+# Validatori HTTP (ETag, Last-Modified) della pagina di ogni playlist.
+# Una voce vuota indica che Spotify non li invia: allora niente rivalidazione.
+_validators_cache = SharedCache("spotify_playlist_validators")
+_validators_executor = ThreadPoolExecutor(max_workers=2)
+
+
+def _has_validators(validators: Optional[Dict]) -> bool:
+    return bool(validators and (validators.get("etag") or validators.get("last_modified")))
+
+
+# Richiesta alla pagina della playlist, condizionale se ci sono validatori.
+# Ritorna (modificata, validatori); validatori None se la richiesta è fallita.
+def revalidate_playlist(playlist_id: str, validators: Dict) -> Tuple[bool, Optional[Dict]]:
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+
+    try:
+        response = get_http_session().get(
+            f"{SPOTIFY_WEB_URL}/playlist/{playlist_id}",
+            headers=headers,
+            timeout=3,
+            stream=True
+        )
+        response.close()
+    except Exception as e:
+        print(f"[SPOTIFY] Rivalidazione fallita per {playlist_id}: {e}")
+        return True, None
+
+    if response.status_code == 304 and headers:
+        return False, validators
+
+    return True, {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified")
+    }
+
+
+# Raccoglie i validatori di una playlist mai vista, in parallelo allo scraping
+def _collect_validators(playlist_id: str):
+    _, validators = revalidate_playlist(playlist_id, {})
+    if validators is not None:
+        _validators_cache.set(playlist_id, validators)
 
-        title = track.get("name", "").strip()
-        artist = ", ".join([a.get("name", "").strip() for a in track.get("artists", [])])
 
-        tracks.append({
-            "title": title,
-            "artist": artist
-        })
+# Ritorna le tracce grezze della playlist, dalla cache se ancora valida.
+# Scaduto il TTL, la playlist si rivalida con una richiesta condizionale solo
+# se la pagina ha validatori; altrimenti si riscarica direttamente.
+def get_playlist_tracks(playlist_url: str) -> List[Dict]:
+    playlist_id = extract_playlist_id(playlist_url)
+    cached = _playlist_cache.get_entry(playlist_id)
 
-    # Salviamo i campi nel CSV
+    if cached is not None:
+        entry, updated_at = cached
+        if time.time() - updated_at < PLAYLIST_CACHE_TTL:
+            return entry["tracks"]
+
+    validators = _validators_cache.get(playlist_id)
+    if cached is not None and _has_validators(validators):
+        changed, new_validators = revalidate_playlist(playlist_id, validators)
+        if not changed:
+            _playlist_cache.touch(playlist_id)
+            return cached[0]["tracks"]
+        if new_validators is not None:
+            _validators_cache.set(playlist_id, new_validators)
+    elif validators is None:
+        _validators_executor.submit(_collect_validators, playlist_id)
+
+    playlist = get_spotify_client().get_playlist_info(playlist_url)
+    tracks = [
+        {"name": t.get("name"), "artists": [{"name": a.get("name", "")} for a in t.get("artists") or []]}
+        for t in playlist.get("tracks", [])
+    ]
+
+    _playlist_cache.set(playlist_id, {"name": playlist.get("name"), "tracks": tracks})
+    return tracks
+
+# ==============================
+# STREAMING DELLE TRACCE
+# ==============================
+
+def parse_track(track: Dict) -> Optional[Dict[str, str]]:
+    # Skippiamo elementi non musicali o incompleti
+    if not track.get("artists") or not track.get("name"):
+        return None
+
+    title = track.get("name", "").strip()
+    artist = ", ".join([a.get("name", "").strip() for a in track.get("artists", [])])
+
+    return {
+        "title": title,
+        "artist": artist
+    }
+
+
+# Emette le tracce a pagine man mano che vengono elaborate
+def iter_playlist_pages(playlist_url: str, page_size: int = PAGE_SIZE) -> Iterator[List[Dict[str, str]]]:
+    page = []
+    for track in get_playlist_tracks(playlist_url):
+        parsed = parse_track(track)
+        if parsed is None:
+            continue
+        page.append(parsed)
+        if len(page) >= page_size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+# Scrive ogni pagina nel CSV e poi ne rilascia le tracce una alla volta
+def stream_playlist_to_csv(playlist_url: str, output_csv_path: str) -> Iterator[Dict[str, str]]:
     fieldnames = ["title", "artist"]
 
     with open(output_csv_path, mode="w", newline="", encoding="utf-8") as f:
         writer = csv.DictWriter(f, fieldnames=fieldnames)
         writer.writeheader()
-        writer.writerows(tracks)
+        for page in iter_playlist_pages(playlist_url):
+            writer.writerows(page)
+            f.flush()
+            yield from page
+
+
+# Scarica la playlist nel processo corrente, entro la scadenza della richiesta.
+# Lo scraping gira in un thread daemon: se Spotify non risponde la richiesta
+# fallisce alla scadenza e il thread si libera da solo al timeout del client,
+# senza bloccare lo spegnimento del worker.
+def scrape_playlist_to_csv(playlist_url: str, output_csv_path: str,
+                           deadline: Optional[Deadline] = None) -> List[Dict[str, str]]:
+    deadline = deadline or Deadline()
+    result = {}
+
+    def scrape():
+        try:
+            result["tracks"] = list(stream_playlist_to_csv(playlist_url, output_csv_path))
+        except Exception as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=scrape, daemon=True)
+    thread.start()
+    thread.join(deadline.remaining())
+
+    if thread.is_alive():
+        raise DeadlineExceeded("scraping della playlist oltre il budget della richiesta")
+    if "error" in result:
+        raise result["error"]
+    return result["tracks"]
+
+
+def spotify_playlist_to_csv(playlist_url, output_csv_path):
+    for _ in stream_playlist_to_csv(playlist_url, output_csv_path):
+        pass
 
-    
     return output_csv_path
 
 
 if __name__ == "__main__":
     import sys
-    
+
     if len(sys.argv) < 3:
         print("Usage: python linktocsvconverter.py <playlist_url> <output_csv>")
         sys.exit(1)
-    
+
     playlist_url = sys.argv[1]
     output_csv = sys.argv[2]
-    
+
     try:
         spotify_playlist_to_csv(playlist_url, output_csv)
     except Exception as e:
@@ -51,4 +235,3 @@ if __name__ == "__main__":
         import traceback
         traceback.print_exc()
         sys.exit(2)
-
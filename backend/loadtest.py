@@ -0,0 +1,535 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import urlparse, parse_qs, unquote
+
+import requests
+
+# ==============================
+# LOAD TEST HARNESS
+# ==============================
+#
+# Genera carico sull'app FastAPI reale (ASGI servita da uvicorn) con tutti i
+# servizi esterni (Spotify, SoundCharts, Last.fm, Deezer, HuggingFace)
+# sostituiti da stub locali. Per ogni livello di concorrenza misura
+# throughput, latenze di coda ed error rate, e verifica che ogni risposta
+# contenga solo le tracce della propria playlist.
+#
+# Esempio:
+#   python loadtest.py --levels 1,2,4,8,16 --requests 40 --tracks 30 --upstream-latency 50
+#   python loadtest.py --levels 4 --incident soundcharts --incident-latency 5000 --incident-rate 0.5
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+FEATURE_NAMES = [
+    "danceability", "energy", "speechiness", "acousticness",
+    "instrumentalness", "liveness", "valence", "tempo"
+]
+
+# ==============================
+# DATI DETERMINISTICI DEGLI STUB
+# ==============================
+
+# Ogni playlist sintetica codifica id e numero di tracce: "lt<seq>n<tracks>"
+def make_playlist_id(seq: int, n_tracks: int) -> str:
+    return f"lt{seq}n{n_tracks}"
+
+
+def parse_playlist_id(playlist_id: str) -> int:
+    return int(playlist_id.rsplit("n", 1)[1])
+
+
+def playlist_tracks(playlist_id: str) -> List[Dict[str, str]]:
+    return [
+        {"title": f"Track {playlist_id} #{i:03d}", "artist": f"Artist {playlist_id}-{i % 3}"}
+        for i in range(parse_playlist_id(playlist_id))
+    ]
+
+
+# UUID SoundCharts derivato dalla query di ricerca "titolo artista"
+def stub_uuid(query: str) -> str:
+    return "sc-" + hashlib.sha1(query.encode("utf-8")).hexdigest()[:20]
+
+
+# Feature audio derivate dall'UUID, così ogni traccia ha valori univoci e verificabili
+def stub_features(uuid: str) -> Dict[str, float]:
+    digest = hashlib.sha1(uuid.encode("utf-8")).digest()
+    features = {name: round(digest[i] / 255, 4) for i, name in enumerate(FEATURE_NAMES)}
+    features["tempo"] = round(60 + digest[7] / 255 * 140, 2)
+    return features
+
+
+def stub_label(features: Dict[str, float]) -> int:
+    return int(features["valence"] >= 0.5) + 2 * int(features["energy"] >= 0.5)
+
+
+# Modello finto con la stessa interfaccia del modello sklearn. La zavorra
+# (ad es. un RandomForest vero) serve solo a rendere realistica la memoria occupata.
+class StubModel:
+    def __init__(self, ballast=None):
+        self.ballast = ballast
+
+    classes_ = [0, 1, 2, 3]
+
+    def predict(self, X):
+        valence = X["valence"].to_numpy(dtype=float)
+        energy = X["energy"].to_numpy(dtype=float)
+        return (valence >= 0.5).astype(int) + 2 * (energy >= 0.5).astype(int)
+
+    # La confidenza cresce con la distanza dalle soglie; l'argmax coincide con predict
+    def predict_proba(self, X):
+        import numpy as np
+        valence = X["valence"].to_numpy(dtype=float)
+        energy = X["energy"].to_numpy(dtype=float)
+        confidence = 0.4 + 1.2 * np.minimum(np.abs(valence - 0.5), np.abs(energy - 0.5))
+        proba = np.repeat(((1 - confidence) / 3)[:, None], 4, axis=1)
+        proba[np.arange(len(X)), self.predict(X)] = confidence
+        return proba
+
+# ==============================
+# STUB HTTP DEI SERVIZI ESTERNI
+# ==============================
+
+# Servizio simulato da ogni percorso degli stub, per gli incidenti mirati
+def stub_provider(path: str) -> Optional[str]:
+    if path.startswith("/api/"):
+        return "soundcharts"
+    if path.startswith("/lastfm"):
+        return "lastfm"
+    if path.startswith("/deezer"):
+        return "deezer"
+    return None
+
+
+class StubUpstreamHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    error_rate = 0.0
+    base_url = ""
+
+    # Incidente: il provider indicato risponde con incident_latency secondi di
+    # ritardo su una frazione incident_rate delle richieste
+    incident_provider = None
+    incident_latency = 0.0
+    incident_rate = 1.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload, status: int = 200, headers: Optional[Dict[str, str]] = None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+        parsed = urlparse(self.path)
+        path = parsed.path
+        query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+
+        if self.incident_provider and stub_provider(path) == self.incident_provider \
+                and random.random() < self.incident_rate:
+            time.sleep(self.incident_latency)
+
+        # La playlist Spotify non fallisce mai: gli errori si simulano solo a valle
+        if path.startswith("/spotify/playlist/"):
+            playlist_id = path.rsplit("/", 1)[1]
+            tracks = [
+                {"name": t["title"], "artists": [{"name": t["artist"]}]}
+                for t in playlist_tracks(playlist_id)
+            ]
+            etag = f'"{stub_uuid(json.dumps(tracks))}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            return self._send_json({"name": playlist_id, "tracks": tracks}, headers={"ETag": etag})
+
+        if self.error_rate and random.random() < self.error_rate:
+            return self._send_json({"error": "stub failure"}, status=500)
+
+        if path.startswith("/api/v2/song/search/"):
+            search = unquote(path.rsplit("/", 1)[1])
+            title, _, artist = search.partition(" Artist ")
+            # Il primo risultato è un remix di un altro artista, come accade con SoundCharts
+            return self._send_json({"items": [
+                {"uuid": "decoy-" + stub_uuid(search), "name": f"{title} (Remix)", "creditName": "Decoy DJ"},
+                {"uuid": stub_uuid(search), "name": title, "creditName": f"Artist {artist}"},
+            ]})
+
+        if path.startswith("/api/v2.25/song/"):
+            uuid = path.rsplit("/", 1)[1]
+            return self._send_json({"object": {"uuid": uuid, "audio": stub_features(uuid)}})
+
+        if path.startswith("/lastfm"):
+            track = {"name": f"Similar {query.get('track', query.get('method'))}",
+                     "artist": {"name": "Stub Artist"}, "image": []}
+            if query.get("method") == "track.search":
+                track["artist"] = "Stub Artist"
+                return self._send_json({"results": {"trackmatches": {"track": [track]}}})
+            return self._send_json({"similartracks": {"track": [track]}})
+
+        if path.startswith("/deezer/search"):
+            return self._send_json({"data": [{
+                "title": query.get("q", ""),
+                "artist": {"name": ""},
+                "album": {"cover_big": f"{self.base_url}/image/cover"}
+            }]})
+
+        if path.startswith("/image/"):
+            body = b"IMG:" + path.rsplit("/", 1)[1].encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        self._send_json({"error": "not found"}, status=404)
+
+
+def start_stub_upstream(latency: float, error_rate: float, incident_provider: Optional[str] = None,
+                        incident_latency: float = 0.0, incident_rate: float = 1.0) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubUpstreamHandler)
+    server.daemon_threads = True
+    StubUpstreamHandler.latency = latency
+    StubUpstreamHandler.error_rate = error_rate
+    StubUpstreamHandler.incident_provider = incident_provider
+    StubUpstreamHandler.incident_latency = incident_latency
+    StubUpstreamHandler.incident_rate = incident_rate
+    StubUpstreamHandler.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+STUB_SPOTIFY_SCRAPER = '''import json
+import os
+import urllib.request
+
+
+class SpotifyClient:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def get_playlist_info(self, url):
+        playlist_id = url.rstrip("/").split("/")[-1].split("?")[0]
+        base = os.environ["LOADTEST_STUB_URL"]
+        with urllib.request.urlopen(f"{base}/spotify/playlist/{playlist_id}") as response:
+            return json.load(response)
+
+    def close(self):
+        pass
+'''
+
+
+# Prepariamo l'ambiente: le variabili vengono ereditate dai sottoprocessi della pipeline
+def configure_stub_environment(stub_url: str) -> str:
+    stub_dir = tempfile.mkdtemp(prefix="playmoodify_stubs_")
+    package_dir = os.path.join(stub_dir, "spotify_scraper")
+    os.makedirs(package_dir)
+    with open(os.path.join(package_dir, "__init__.py"), "w", encoding="utf-8") as f:
+        f.write(STUB_SPOTIFY_SCRAPER)
+
+    os.environ["LOADTEST_STUB_URL"] = stub_url
+    os.environ["SOUNDCHARTS_API_URL"] = stub_url
+    os.environ["LASTFM_API_URL"] = f"{stub_url}/lastfm"
+    os.environ["DEEZER_API_URL"] = f"{stub_url}/deezer"
+    os.environ["SPOTIFY_WEB_URL"] = f"{stub_url}/spotify"
+    os.environ["TRACK_INDEX_PATH"] = os.path.join(stub_dir, "track_index.db")
+    os.environ["PLAYMOODIFY_CACHE_PATH"] = os.path.join(stub_dir, "cache.db")
+    os.environ["PYTHONPATH"] = os.pathsep.join(
+        p for p in [stub_dir, os.environ.get("PYTHONPATH", "")] if p
+    )
+    sys.path.insert(0, stub_dir)
+    return stub_dir
+
+# ==============================
+# APP ASGI REALE
+# ==============================
+
+def start_app(port: int = 0):
+    import socket
+    import uvicorn
+
+    sys.path.insert(0, BACKEND_DIR)
+    import utils
+    utils._model = StubModel()
+    import app as app_module
+
+    if port == 0:
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+
+    config = uvicorn.Config(app_module.app, host="127.0.0.1", port=port, log_level="warning")
+    server = uvicorn.Server(config)
+    threading.Thread(target=server.run, daemon=True).start()
+
+    deadline = time.time() + 30
+    while not server.started:
+        if time.time() > deadline:
+            raise RuntimeError("uvicorn non si è avviato entro 30s")
+        time.sleep(0.05)
+
+    return server, f"http://127.0.0.1:{port}"
+
+# ==============================
+# VERIFICA RISPOSTE
+# ==============================
+
+# Ritorna (esito, dettaglio): esito è "ok", "error" o "corrupt"
+def check_playlist_response(playlist_id: str, response: requests.Response):
+    if response.status_code != 200:
+        return "error", f"HTTP {response.status_code}"
+
+    data = response.json()
+    if data.get("status") != "success":
+        return "error", data.get("error", "status != success")
+
+    expected_order = [(t["title"], t["artist"]) for t in playlist_tracks(playlist_id)]
+    expected = set(expected_order)
+    seen = set()
+
+    for track in data.get("tracks", []):
+        key = (track.get("title"), track.get("artist"))
+        if key not in expected:
+            return "corrupt", f"traccia estranea {key!r}"
+        if key in seen:
+            return "corrupt", f"traccia duplicata {key!r}"
+        seen.add(key)
+
+        uuid = stub_uuid(f"{key[0]} {key[1]}")
+        if track.get("uuid") != uuid:
+            return "corrupt", f"uuid errato per {key!r}"
+
+        features = stub_features(uuid)
+        for name, value in features.items():
+            if abs(float(track.get(name, -1)) - value) > 1e-6:
+                return "corrupt", f"feature {name} errata per {key!r}"
+
+        if int(track.get("label", -1)) != stub_label(features):
+            return "corrupt", f"label errata per {key!r}"
+
+    # Le tracce devono seguire l'ordine della playlist
+    returned = [(t.get("title"), t.get("artist")) for t in data.get("tracks", [])]
+    if returned != [key for key in expected_order if key in seen]:
+        return "corrupt", "tracce fuori ordine"
+
+    # Con errori iniettati negli stub alcune tracce mancano, ma devono comparire tra le scartate
+    skipped = {(t.get("title"), t.get("artist")) for t in data.get("skipped_tracks", [])}
+    if skipped & seen or (seen | skipped) != expected:
+        return "corrupt", f"{len(expected - seen - skipped)} tracce perse senza stato"
+
+    return "ok", ""
+
+
+def check_image_response(token: str, response: requests.Response):
+    if response.status_code != 200:
+        return "error", f"HTTP {response.status_code}"
+    if response.headers.get("content-type", "").startswith("application/json"):
+        return "error", "immagine non recuperata"
+    if response.content != b"IMG:" + token.encode("utf-8"):
+        return "corrupt", f"immagine errata per {token}"
+    return "ok", ""
+
+# ==============================
+# GENERATORE DI CARICO
+# ==============================
+
+class LoadGenerator:
+    def __init__(self, app_url: str, stub_url: str, tracks: int, image_ratio: float, timeout: float):
+        self.app_url = app_url
+        self.stub_url = stub_url
+        self.tracks = tracks
+        self.image_ratio = image_ratio
+        self.timeout = timeout
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _next_seq(self) -> int:
+        with self._lock:
+            self._seq += 1
+            return self._seq
+
+    def _session(self) -> requests.Session:
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    # Esegue una singola richiesta e ritorna (endpoint, esito, latenza, dettaglio)
+    def one_request(self):
+        seq = self._next_seq()
+        session = self._session()
+        endpoint = "image" if random.random() < self.image_ratio else "process"
+        start = time.perf_counter()
+
+        try:
+            if endpoint == "image":
+                token = f"img{seq}"
+                response = session.get(
+                    f"{self.app_url}/api/image",
+                    params={"url": f"{self.stub_url}/image/{token}"},
+                    timeout=self.timeout,
+                )
+                outcome, detail = check_image_response(token, response)
+            else:
+                playlist_id = make_playlist_id(seq, self.tracks)
+                response = session.post(
+                    f"{self.app_url}/process-playlist",
+                    json={"playlist_url": f"https://open.spotify.com/playlist/{playlist_id}"},
+                    timeout=self.timeout,
+                )
+                outcome, detail = check_playlist_response(playlist_id, response)
+        except Exception as e:
+            outcome, detail = "error", str(e)
+
+        return endpoint, outcome, time.perf_counter() - start, detail
+
+    def run_level(self, concurrency: int, total_requests: int) -> Dict:
+        results = []
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(self.one_request) for _ in range(total_requests)]
+            for future in futures:
+                results.append(future.result())
+        elapsed = time.perf_counter() - start
+        return summarize(concurrency, results, elapsed)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[rank]
+
+
+def summarize(concurrency: int, results: List, elapsed: float) -> Dict:
+    latencies = [r[2] for r in results if r[1] == "ok"]
+    errors = [r for r in results if r[1] == "error"]
+    corrupt = [r for r in results if r[1] == "corrupt"]
+    return {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "ok": len(latencies),
+        "errors": len(errors),
+        "corrupt": len(corrupt),
+        "error_rate": len(errors) / len(results) if results else 0.0,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies) * 1000 if latencies else 0.0,
+        # Anche le risposte di errore contano: durante un incidente devono arrivare in fretta
+        "p99_all_ms": percentile([r[2] for r in results], 99) * 1000,
+        "samples": [r[3] for r in errors + corrupt][:5],
+    }
+
+
+# Il punto di saturazione è il primo livello oltre il quale il throughput
+# cresce meno della soglia indicata
+def find_saturation(levels: List[Dict], min_gain: float = 0.10) -> Optional[Dict]:
+    if not levels:
+        return None
+    best = max(levels, key=lambda l: l["throughput_rps"])
+    knee = levels[-1]
+    for prev, cur in zip(levels, levels[1:]):
+        if cur["throughput_rps"] < prev["throughput_rps"] * (1 + min_gain):
+            knee = prev
+            break
+    return {
+        "max_throughput_rps": best["throughput_rps"],
+        "max_throughput_concurrency": best["concurrency"],
+        "saturation_concurrency": knee["concurrency"],
+    }
+
+
+def print_report(levels: List[Dict], saturation: Optional[Dict]):
+    header = f"{'conc':>5} {'req':>5} {'ok':>5} {'err':>5} {'corr':>5} {'rps':>8} {'p50ms':>8} {'p95ms':>8} {'p99ms':>8} {'maxms':>8} {'p99all':>8}"
+    print(header)
+    print("-" * len(header))
+    for l in levels:
+        print(f"{l['concurrency']:>5} {l['requests']:>5} {l['ok']:>5} {l['errors']:>5} {l['corrupt']:>5} "
+              f"{l['throughput_rps']:>8.2f} {l['p50_ms']:>8.1f} {l['p95_ms']:>8.1f} {l['p99_ms']:>8.1f} {l['max_ms']:>8.1f} {l['p99_all_ms']:>8.1f}")
+        for sample in l["samples"]:
+            print(f"      ! {sample}")
+
+    if saturation:
+        print(f"\nThroughput massimo: {saturation['max_throughput_rps']:.2f} req/s "
+              f"a concorrenza {saturation['max_throughput_concurrency']}")
+        print(f"Saturazione a concorrenza: {saturation['saturation_concurrency']}")
+
+    if any(l["corrupt"] for l in levels):
+        print("\n[LOADTEST] ⚠️ Rilevata corruzione tra richieste concorrenti")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test dell'API PlayMoodify con upstream stub")
+    parser.add_argument("--levels", default="1,2,4,8,16", help="livelli di concorrenza separati da virgola")
+    parser.add_argument("--requests", type=int, default=40, help="richieste per livello")
+    parser.add_argument("--tracks", type=int, default=20, help="tracce per playlist sintetica")
+    parser.add_argument("--image-ratio", type=float, default=0.3, help="frazione di richieste a /api/image")
+    parser.add_argument("--upstream-latency", type=float, default=20.0, help="latenza degli stub in ms")
+    parser.add_argument("--upstream-error-rate", type=float, default=0.0, help="frazione di risposte 500 dagli stub")
+    parser.add_argument("--incident", choices=["soundcharts", "lastfm", "deezer"], default=None,
+                        help="provider che simula un rallentamento")
+    parser.add_argument("--incident-latency", type=float, default=5000.0, help="ritardo dell'incidente in ms")
+    parser.add_argument("--incident-rate", type=float, default=1.0, help="frazione di richieste rallentate")
+    parser.add_argument("--target", default=None, help="URL di un'app già avviata (con gli stessi stub)")
+    parser.add_argument("--stub-url", default=None, help="URL di stub già avviati (con --target)")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--json", default=None, help="salva il report in JSON")
+    args = parser.parse_args(argv)
+
+    if args.stub_url:
+        stub_url = args.stub_url
+    else:
+        stub = start_stub_upstream(
+            args.upstream_latency / 1000, args.upstream_error_rate,
+            args.incident, args.incident_latency / 1000, args.incident_rate
+        )
+        stub_url = f"http://127.0.0.1:{stub.server_address[1]}"
+    configure_stub_environment(stub_url)
+
+    if args.target:
+        app_url = args.target
+    else:
+        _, app_url = start_app()
+
+    generator = LoadGenerator(app_url, stub_url, args.tracks, args.image_ratio, timeout=args.timeout)
+
+    levels = []
+    for concurrency in [int(c) for c in args.levels.split(",") if c.strip()]:
+        print(f"[LOADTEST] concorrenza {concurrency}...", flush=True)
+        levels.append(generator.run_level(concurrency, args.requests))
+
+    saturation = find_saturation(levels)
+    print()
+    print_report(levels, saturation)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"levels": levels, "saturation": saturation}, f, indent=2)
+
+    return 1 if any(l["corrupt"] for l in levels) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,10 @@
+import numpy as np
 import pandas as pd
+from typing import Dict, List, Optional
+
+from pipeline_utils import STATUS_RESOLVED, STATUS_FEATURE_MISSING
+from feature_validation import validate_features, predict_with_imputation, MIN_OBSERVED_FEATURES
+from shared_cache import SharedCache
 
 # ==============================
 # FEATURE AUDIO
@@ -15,38 +21,180 @@ FEATURE_COLUMNS = [
     "tempo"
 ]
 
+# Predizioni per (versione modello, UUID, feature), condivise tra i worker
+_label_cache = SharedCache("labels", ttl=30 * 24 * 3600)
+
+# Colonne con la probabilità di ogni mood nelle tracce ("prob_0", "prob_1", ...)
+PROBABILITY_PREFIX = "prob_"
+
+# Quante tracce incerte riportare nel riepilogo della playlist
+UNCERTAIN_TOP_K = 5
+
 # ==============================
 # MOOD CALCULATION
 # ==============================
 
+# Chiavi di cache delle etichette: cambiano se cambiano il modello o le feature della traccia
+def _label_cache_keys(model_version: str, df: pd.DataFrame, X: pd.DataFrame) -> pd.Series:
+    feature_hash = pd.util.hash_pandas_object(X.round(6), index=False).astype(str)
+    return model_version + ":" + df["uuid"].astype(str) + ":" + feature_hash
+
 # Prevediamo il mood delle singole tracce e calcoliamo statistiche complessive
-def calculate_moods(csv_with_features: str, model):
-    df = pd.read_csv(csv_with_features)
+def calculate_moods(csv_with_features: str, model, model_version: Optional[str] = None):
+    # Solo le celle vuote delle feature sono valori mancanti: "N/A" è uno stato valido
+    df_all = pd.read_csv(
+        csv_with_features,
+        keep_default_na=False,
+        na_values={c: [""] for c in FEATURE_COLUMNS}
+    )
+
+    # Le colonne feature mancanti vengono trattate come valori da imputare
+    missing_columns = [c for c in FEATURE_COLUMNS if c not in df_all.columns]
+    if missing_columns:
+        print(f"[MOOD] ⚠️ Colonne feature mancanti, verranno imputate: {missing_columns}")
 
-    # Controlliamo che tutte le colonne feature siano presenti
-    missing = [c for c in FEATURE_COLUMNS if c not in df.columns]
-    if missing:
-        print(f"[MOOD] ⚠️ Colonne feature mancanti: {missing}")
-        raise ValueError(f"Colonne feature mancanti: {missing}")
+    # Validazione vettoriale: valori non numerici o fuori range diventano mancanti
+    X_all, missing_all = validate_features(df_all)
+    X_all = X_all[FEATURE_COLUMNS]
+    missing_all = missing_all[FEATURE_COLUMNS]
 
-    # Verifica che ci siano tracce da analizzare
+    # Classifichiamo le tracce risolte con abbastanza feature osservate
+    classifiable = (~missing_all).sum(axis=1) >= MIN_OBSERVED_FEATURES
+    if "status" in df_all.columns:
+        resolved = df_all["status"] == STATUS_RESOLVED
+        df_all.loc[resolved & ~classifiable, "status"] = STATUS_FEATURE_MISSING
+        classifiable &= resolved
+    df = df_all[classifiable].copy()
+
+    # Verifica che ci siano tracce da analizzare. Lo stato aggiornato va salvato
+    # comunque, così le tracce risultano tra le scartate (get_skipped_tracks)
     if len(df) == 0:
+        df_all.to_csv(csv_with_features, index=False)
         raise ValueError("Nessuna traccia disponibile per l'analisi del mood")
 
-    # Estrazione delle feature audio dal csv
-    X = df[FEATURE_COLUMNS]
+    missing = missing_all[classifiable]
+    X = X_all[classifiable].copy()
+    labels = pd.Series(-1, index=df.index)
+
+    # Con un modello probabilistico teniamo anche le probabilità per classe
+    # (array numpy allineato alle righe di df, una colonna per classe)
+    classes = [int(c) for c in getattr(model, "classes_", [])]
+    proba = None
+    if hasattr(model, "predict_proba") and classes:
+        proba = np.full((len(df), len(classes)), np.nan)
+
+    # Recuperiamo le predizioni già calcolate (anche da altri worker) per le tracce complete
+    cacheable = ~missing.any(axis=1)
+    if model_version and "uuid" in df.columns:
+        keys = _label_cache_keys(model_version, df, X)
+        cached = keys[cacheable].map(_label_cache.get_many(keys[cacheable])).dropna()
+        usable = cached[cached.map(lambda e: isinstance(e, dict) and (proba is None or e.get("proba") is not None))]
+        if len(usable):
+            labels[usable.index] = usable.map(lambda e: e["label"]).astype(int)
+            if proba is not None:
+                proba[df.index.get_indexer(usable.index)] = np.array([e["proba"] for e in usable])
+
+    # Tramite il modello prevediamo il mood per le altre tracce, imputando le feature
+    # mancanti: i valori imputati servono solo alla predizione e non vengono restituiti
+    to_predict = labels < 0
+    if to_predict.all():
+        # Caso comune (nessuna predizione in cache): niente selezioni per maschera
+        predicted, _, predicted_proba = predict_with_imputation(model, X, missing)
+        labels[:] = predicted
+        if proba is not None:
+            proba = predicted_proba
+    elif to_predict.any():
+        predicted, _, predicted_proba = predict_with_imputation(model, X[to_predict], missing[to_predict])
+        labels[to_predict] = predicted
+        if proba is not None:
+            proba[to_predict.to_numpy()] = predicted_proba
+
+    if to_predict.any() and model_version and "uuid" in df.columns:
+        new = (to_predict & cacheable).to_numpy()
+        new_labels = labels.to_numpy()[new]
+        new_proba = proba[new].tolist() if proba is not None else [None] * int(new.sum())
+        _label_cache.set_many({
+            key: {"label": int(label), "proba": p}
+            for key, label, p in zip(keys[new], new_labels, new_proba)
+        })
+
+    # Feature restituite al client: solo i valori osservati, None (null nel JSON) dove mancano
+    df[FEATURE_COLUMNS] = X.astype(object).where(X.notna(), None)
+    df["label"] = labels.astype(int)
 
-    # Tramite il modello prevediamo il mood per ogni traccia
-    df["label"] = model.predict(X).astype(int)
+    # Segnaliamo quali tracce e quali feature sono state imputate
+    df["imputed"] = missing.any(axis=1)
+    df["imputed_features"] = [
+        ",".join(np.array(FEATURE_COLUMNS)[row]) for row in missing.to_numpy()
+    ]
+
+    # Confidenza della predizione e probabilità per mood di ogni traccia,
+    # aggiunte con un'unica operazione invece di una colonna alla volta
+    if proba is not None:
+        prob_columns = ["confidence"] + [f"{PROBABILITY_PREFIX}{c}" for c in classes]
+        df = pd.concat(
+            [df, pd.DataFrame(np.column_stack([proba.max(axis=1), proba]), index=df.index, columns=prob_columns)],
+            axis=1
+        )
 
     # Calcolo delle statistiche sul mood della playlist
     overall = {
         "mood_mode": int(df["label"].mode()[0]),
         "mood_distribution": df["label"].value_counts(normalize=True).to_dict(),
-        "total_tracks": int(len(df))
+        "total_tracks": int(len(df)),
+        "imputed_tracks": int(df["imputed"].sum())
     }
+    if proba is not None:
+        overall["mood_probability_distribution"] = dict(zip(classes, proba.mean(axis=0).tolist()))
+        overall["uncertain_tracks"] = uncertain_tracks_from_proba(df, proba)
+    if "status" in df_all.columns:
+        overall["track_status"] = df_all["status"].value_counts().to_dict()
 
-    # Salviamo le etichette nel CSV
-    df.to_csv(csv_with_features, index=False)
+    # Salviamo le etichette nel CSV, mantenendo anche le tracce non classificate
+    df_all.loc[df.index, "label"] = df["label"]
+    df_all.to_csv(csv_with_features, index=False)
 
     return df, overall
+
+
+# Le tracce più incerte: minimo scarto tra le due probabilità più alte
+def get_uncertain_tracks(df: pd.DataFrame, k: int = UNCERTAIN_TOP_K) -> List[Dict]:
+    prob_columns = [c for c in df.columns if str(c).startswith(PROBABILITY_PREFIX)]
+    if not prob_columns or len(df) == 0:
+        return []
+
+    return uncertain_tracks_from_proba(df, df[prob_columns].to_numpy(dtype=float), k)
+
+
+# Come get_uncertain_tracks, con le probabilità già in una matrice allineata a df
+def uncertain_tracks_from_proba(df: pd.DataFrame, P: np.ndarray, k: int = UNCERTAIN_TOP_K) -> List[Dict]:
+    if P.shape[1] > 1:
+        top_two = -np.partition(-P, 1, axis=1)[:, :2]
+        margin = top_two[:, 0] - top_two[:, 1]
+    else:
+        margin = P[:, 0]
+
+    # Selezione parziale dei k scarti minimi, poi ordinati (a parità vale la posizione)
+    k = min(k, len(margin))
+    candidates = np.argpartition(margin, k - 1)[:k] if k < len(margin) else np.arange(len(margin))
+    order = candidates[np.lexsort((candidates, margin[candidates]))]
+
+    columns = [c for c in ["position", "title", "artist", "label", "confidence"] if c in df.columns]
+    uncertain = df.iloc[order][columns].to_dict(orient="records")
+    for record, value in zip(uncertain, margin[order].tolist()):
+        record["margin"] = value
+    return uncertain
+
+
+# Tracce della playlist rimaste senza mood, con posizione e stato
+def get_skipped_tracks(csv_with_features: str) -> List[Dict]:
+    df = pd.read_csv(csv_with_features, keep_default_na=False)
+    if "status" not in df.columns:
+        return []
+
+    columns = [c for c in ["position", "title", "artist", "status"] if c in df.columns]
+    if "label" in df.columns:
+        skipped = df[df["label"] == ""]
+    else:
+        skipped = df[df["status"] != STATUS_RESOLVED]
+    return skipped[columns].to_dict(orient="records")
@@ -0,0 +1,50 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+# ==============================
+# STATO DELLE TRACCE
+# ==============================
+
+# Ogni riga dei CSV intermedi porta con sé l'esito della risoluzione,
+# così nessuna traccia viene scartata in silenzio lungo la pipeline.
+STATUS_RESOLVED = "resolved"
+STATUS_NOT_FOUND = "N/A"
+STATUS_FEATURE_MISSING = "feature-missing"
+STATUS_ERROR = "error"
+
+# ==============================
+# PARALLEL MAP ORDINATO
+# ==============================
+
+# Applica fn agli elementi in parallelo e restituisce i risultati nell'ordine di input.
+# Al più max_pending task sono in volo o in attesa di essere restituiti: i worker
+# continuano a lavorare mentre la testa della coda è lenta, ma il buffer di
+# riordino resta limitato anche su playlist molto grandi.
+def ordered_map(
+    fn: Callable[[T], R],
+    items: Iterable[T],
+    max_workers: int = 8,
+    max_pending: Optional[int] = None,
+) -> Iterator[R]:
+    if max_pending is None:
+        max_pending = max_workers * 4
+    max_pending = max(max_pending, max_workers)
+
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for item in items:
+                pending.append(executor.submit(fn, item))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Se il consumatore si ferma prima, non aspettiamo i task non ancora avviati
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,186 @@
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import pandas as pd
+
+from shared_cache import SharedCache
+from mood_analysis import PROBABILITY_PREFIX, get_uncertain_tracks
+from pipeline_utils import STATUS_ERROR
+
+# ==============================
+# STATO PERSISTITO DELLE PLAYLIST
+# ==============================
+
+# Per ogni playlist salviamo tracce classificate, tracce scartate, conteggi per
+# mood e raccomandazioni, così una nuova analisi elabora solo le differenze.
+_state_cache = SharedCache("playlist_state")
+
+TrackKey = Tuple[str, str, int]
+
+
+def load_state(playlist_id: str) -> Optional[Dict]:
+    return _state_cache.get(playlist_id)
+
+
+def save_state(playlist_id: str, state: Dict):
+    _state_cache.set(playlist_id, state)
+
+
+# Probabilità per mood di una traccia, dalle colonne "prob_<mood>"
+def _track_probabilities(track: Dict) -> Dict[int, float]:
+    return {
+        int(key[len(PROBABILITY_PREFIX):]): float(value)
+        for key, value in track.items()
+        if key.startswith(PROBABILITY_PREFIX)
+    }
+
+
+def build_state(tracks: List[Dict], skipped: List[Dict], recommendations: Dict,
+                model_version: Optional[str]) -> Dict:
+    counts = Counter(int(t["label"]) for t in tracks)
+    prob_sums = Counter()
+    for track in tracks:
+        prob_sums.update(_track_probabilities(track))
+
+    return {
+        "model_version": model_version,
+        "tracks": tracks,
+        "skipped": skipped,
+        "mood_counts": {str(label): n for label, n in counts.items()},
+        "mood_prob_sums": {str(label): p for label, p in prob_sums.items()},
+        "recommendations": recommendations
+    }
+
+# ==============================
+# DIFF TRA SCRAPE E STATO
+# ==============================
+
+# Una playlist può contenere più volte la stessa canzone: la chiave include
+# l'occorrenza, così i duplicati vengono confrontati uno a uno
+def track_keys(rows: Iterable[Dict]) -> List[TrackKey]:
+    seen = Counter()
+    keys = []
+    for row in rows:
+        base = (str(row.get("title", "")).strip(), str(row.get("artist", "")).strip())
+        keys.append((base[0], base[1], seen[base]))
+        seen[base] += 1
+    return keys
+
+
+def _state_records(state: Dict) -> Dict[TrackKey, Tuple[str, Dict]]:
+    rows = [("tracks", t) for t in state["tracks"]] + [("skipped", t) for t in state["skipped"]]
+    rows.sort(key=lambda r: int(r[1].get("position") or 0))
+    keys = track_keys(record for _, record in rows)
+    return dict(zip(keys, rows))
+
+
+# Tracce scartate per un errore temporaneo (servizio giù, budget esaurito):
+# vanno rielaborate. N/A e feature-missing sono invece esiti definitivi.
+def _needs_retry(record: Tuple[str, Dict]) -> bool:
+    kind, track = record
+    return kind == "skipped" and track.get("status") == STATUS_ERROR
+
+
+# Confronta la playlist appena scaricata con lo stato salvato.
+# Ritorna le righe da elaborare (nell'ordine della playlist) e le loro chiavi:
+# le tracce nuove e quelle da riprovare.
+def diff_playlist(state: Dict, scraped: List[Dict]) -> Tuple[List[Dict], List[TrackKey]]:
+    known = _state_records(state)
+    added_rows, added_keys = [], []
+    for row, key in zip(scraped, track_keys(scraped)):
+        if key not in known or _needs_retry(known[key]):
+            added_rows.append({"title": key[0], "artist": key[1]})
+            added_keys.append(key)
+    return added_rows, added_keys
+
+
+# Applica il diff allo stato: rimuove le tracce uscite, inserisce quelle nuove
+# (già elaborate dalla pipeline, con posizione relativa alla lista added_keys)
+# e aggiorna i conteggi per mood in modo incrementale.
+# Ritorna il nuovo stato, i mood la cui composizione è cambiata e il riepilogo del diff.
+def apply_diff(state: Dict, scraped: List[Dict], added_keys: List[TrackKey],
+               new_tracks: List[Dict], new_skipped: List[Dict]) -> Tuple[Dict, Set[int], Dict]:
+    known = _state_records(state)
+    scraped_keys = track_keys(scraped)
+
+    added = {}
+    for kind, records in (("tracks", new_tracks), ("skipped", new_skipped)):
+        for record in records:
+            added[added_keys[int(record["position"]) - 1]] = (kind, record)
+
+    # Tracce nuove che la pipeline non ha restituito: scartate, mai perse
+    for position, key in enumerate(added_keys, start=1):
+        if key not in added:
+            added[key] = ("skipped", {"position": position, "title": key[0], "artist": key[1], "status": STATUS_ERROR})
+
+    counts = Counter({int(label): n for label, n in state["mood_counts"].items()})
+    prob_sums = {int(label): p for label, p in state.get("mood_prob_sums", {}).items()}
+    changed_moods = set()
+
+    # Tracce uscite dalla playlist
+    current = set(scraped_keys)
+    removed = [known[key] for key in known if key not in current]
+    for kind, record in removed:
+        if kind == "tracks":
+            counts[int(record["label"])] -= 1
+            changed_moods.add(int(record["label"]))
+            for label, p in _track_probabilities(record).items():
+                prob_sums[label] = prob_sums.get(label, 0.0) - p
+
+    # Tracce entrate nella playlist
+    for kind, record in added.values():
+        if kind == "tracks":
+            counts[int(record["label"])] += 1
+            changed_moods.add(int(record["label"]))
+            for label, p in _track_probabilities(record).items():
+                prob_sums[label] = prob_sums.get(label, 0.0) + p
+
+    # Ricostruiamo le liste nell'ordine della nuova playlist
+    tracks, skipped = [], []
+    for position, key in enumerate(scraped_keys, start=1):
+        kind, record = added.get(key) or known[key]
+        record = dict(record, position=position)
+        (tracks if kind == "tracks" else skipped).append(record)
+
+    new_state = dict(
+        state,
+        tracks=tracks,
+        skipped=skipped,
+        mood_counts={str(label): n for label, n in counts.items() if n > 0},
+        mood_prob_sums={str(label): max(p, 0.0) for label, p in prob_sums.items()}
+    )
+    retried = sum(1 for key in added_keys if key in known)
+    summary = {"added": len(added_keys) - retried, "removed": len(removed), "retried": retried}
+    return new_state, changed_moods, summary
+
+# ==============================
+# STATISTICHE DAI CONTEGGI
+# ==============================
+
+# Stesse statistiche di calculate_moods, ricavate dai conteggi salvati
+def overall_from_state(state: Dict) -> Dict:
+    counts = {int(label): n for label, n in state["mood_counts"].items() if n > 0}
+    total = sum(counts.values())
+
+    # Come pandas.mode: a parità di conteggio vince l'etichetta più piccola
+    top = max(counts.values()) if counts else 0
+    ordered = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+
+    status = Counter(t.get("status") for t in state["tracks"] + state["skipped"] if t.get("status"))
+    overall = {
+        "mood_mode": min(label for label, n in counts.items() if n == top) if counts else None,
+        "mood_distribution": {label: n / total for label, n in ordered},
+        "total_tracks": total,
+        "imputed_tracks": sum(1 for t in state["tracks"] if t.get("imputed"))
+    }
+
+    # Distribuzione pesata per probabilità, dalla somma delle probabilità delle tracce
+    prob_sums = state.get("mood_prob_sums")
+    if prob_sums and total:
+        overall["mood_probability_distribution"] = {
+            int(label): p / total for label, p in sorted(prob_sums.items(), key=lambda item: int(item[0]))
+        }
+        overall["uncertain_tracks"] = get_uncertain_tracks(pd.DataFrame(state["tracks"]))
+
+    overall["track_status"] = dict(status)
+    return overall
@@ -1,20 +1,60 @@
-import requests
 import pandas as pd
-from typing import Optional, Dict, Set
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Optional, Dict, Set
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
 import time
+import os
+
+from shared_cache import SharedCache
+from resilience import LASTFM, DEEZER, Deadline
+
+LASTFM_API_URL = os.getenv("LASTFM_API_URL", "https://ws.audioscrobbler.com/2.0/")
+DEEZER_API_URL = os.getenv("DEEZER_API_URL", "https://api.deezer.com")
+LASTFM_API_KEY = os.getenv("LASTFM_API_KEY", "481d0ece35e3d695d07d399427f5ef04")
+
+# ========================================
+# CACHE DEI PROVIDER
+# ========================================
+
+# Risultati recenti di Last.fm e Deezer: entro il TTL evitano la chiamata,
+# oltre il TTL servono ancora se il provider non risponde
+_lastfm_cache = SharedCache("lastfm", ttl=24 * 3600)
+_deezer_cache = SharedCache("deezer_images", ttl=7 * 24 * 3600)
+
+
+# Ritorna il valore in cache se valido, altrimenti chiama fetch e salva il risultato.
+# Se fetch fallisce usa la voce scaduta, se c'è; altrimenti rilancia l'errore.
+def _cached_call(cache: SharedCache, key: str, fetch: Callable):
+    cached = cache.get_entry(key)
+    if cached is not None and time.time() - cached[1] <= cache.ttl:
+        return cached[0]
+
+    try:
+        value = fetch()
+    except Exception:
+        if cached is not None:
+            return cached[0]
+        raise
+
+    if value:
+        cache.set(key, value)
+    return value
 
 # ========================================
 # DEEZER API - Ricerca immagini tracce
 # ========================================
 
-def get_track_image_from_deezer(track_name: str, artist_name: str) -> Optional[str]:
+def get_track_image_from_deezer(track_name: str, artist_name: str,
+                                deadline: Optional[Deadline] = None) -> Optional[str]:
+    def fetch():
+        response = DEEZER.get(
+            f"{DEEZER_API_URL}/search",
+            deadline=deadline,
+            params={"q": f"{track_name} {artist_name}", "limit": 10}
+        )
+        return {"data": response.json().get("data", [])}
+
     try:
-        results = requests.get(
-            "https://api.deezer.com/search",
-            params={"q": f"{track_name} {artist_name}", "limit": 10},
-            timeout=3
-        ).json().get("data", [])
+        results = _cached_call(_deezer_cache, f"{track_name}:{artist_name}", fetch)["data"]
         
         track, artist = track_name.lower().strip(), artist_name.lower().strip()
         
@@ -86,116 +126,86 @@ FALLBACK_RECOMMENDATIONS = {
 # LASTFM API FUNCTIONS
 # ==============================
 
+# Immagine più grande disponibile di una traccia Last.fm
+def _extract_lastfm_image(track: dict) -> Optional[str]:
+    images = track.get("image")
+    if isinstance(images, list):
+        for img in reversed(images):
+            if img.get("size") == "extralarge" or img.get("size") == "large":
+                image_url = img.get("#text", "")
+                if image_url:
+                    return image_url
+    return None
+
+
 # Ricerca tracce su Last.fm per keyword
-def search_lastfm_track(search_keyword: str, lastfm_api_key: str, limit: int = 5):
-
-    max_retries = 2
-    for attempt in range(max_retries):
-        try:
-            url = "https://ws.audioscrobbler.com/2.0/"
-            params = {
-                "method": "track.search",
-                "track": search_keyword,
-                "api_key": lastfm_api_key,
-                "format": "json",
-                "limit": limit
-            }
-            
-            response = requests.get(url, params=params, timeout=3)
-            
-            if response.status_code == 200:
-                data = response.json()
-                tracks = data.get("results", {}).get("trackmatches", {}).get("track", [])
-                
-                if isinstance(tracks, list):
-                    # Estrai immagini da ogni traccia
-                    for track in tracks:
-                        image_url = None
-                        if "image" in track:
-                            images = track["image"]
-                            if isinstance(images, list):
-                                for img in reversed(images):
-                                    if img.get("size") == "extralarge" or img.get("size") == "large":
-                                        image_url = img.get("#text", "")
-                                        if image_url:
-                                            break
-                        track["image_url"] = image_url
-                    return tracks
-                elif tracks:
-                    image_url = None
-                    if "image" in tracks:
-                        images = tracks["image"]
-                        if isinstance(images, list):
-                            for img in reversed(images):
-                                if img.get("size") == "extralarge" or img.get("size") == "large":
-                                    image_url = img.get("#text", "")
-                                    if image_url:
-                                        break
-                    tracks["image_url"] = image_url
-                    return [tracks]
-                else:
-                    return []
-            
+def search_lastfm_track(search_keyword: str, lastfm_api_key: str, limit: int = 5,
+                        deadline: Optional[Deadline] = None):
+    cache_key = f"search:{search_keyword}:{limit}"
+
+    def fetch():
+        params = {
+            "method": "track.search",
+            "track": search_keyword,
+            "api_key": lastfm_api_key,
+            "format": "json",
+            "limit": limit
+        }
+        response = LASTFM.get(LASTFM_API_URL, deadline=deadline, params=params)
+        if response.status_code != 200:
             return []
-            
-        except Exception as e:
-            print(f"[LASTFM-SEARCH] Tentativo {attempt+1}/{max_retries} fallito per '{search_keyword}': {e}")
-            if attempt < max_retries - 1:
-                time.sleep(0.5)
-    
-    return []
+
+        tracks = response.json().get("results", {}).get("trackmatches", {}).get("track", [])
+        if isinstance(tracks, dict):
+            tracks = [tracks]
+        for track in tracks or []:
+            track["image_url"] = _extract_lastfm_image(track)
+        return tracks or []
+
+    try:
+        return _cached_call(_lastfm_cache, cache_key, fetch) or []
+    except Exception as e:
+        print(f"[LASTFM-SEARCH] Ricerca fallita per '{search_keyword}': {e}")
+        return []
 
 # Ricerca traccia simile su Last.fm con API
-def get_similar_track(title: str, artist: str, lastfm_api_key: str):
-    
-    max_retries = 2
-    for attempt in range(max_retries):
-        try:
-            url = "https://ws.audioscrobbler.com/2.0/"
-            params = {
-                "method": "track.getSimilar",
-                "artist": artist,
-                "track": title,
-                "api_key": lastfm_api_key,
-                "format": "json",
-                "limit": 5
-            }
-            
-            response = requests.get(url, params=params, timeout=3)
-            
-            if response.status_code == 200:
-                data = response.json()
-                similar_tracks = data.get("similartracks", {}).get("track", [])
-                
-                # Prendi il primo risultato
-                if isinstance(similar_tracks, list) and len(similar_tracks) > 0:
-                    track = similar_tracks[0]
-                    # Estrai l'immagine più grande disponibile
-                    image_url = None
-                    if "image" in track:
-                        images = track["image"]
-                        if isinstance(images, list):
-                            for img in reversed(images):
-                                if img.get("size") == "extralarge" or img.get("size") == "large":
-                                    image_url = img.get("#text", "")
-                                    if image_url:
-                                        break
-                    track["image_url"] = image_url
-                    return track
-                elif similar_tracks:
-                    similar_tracks["image_url"] = None
-                    return similar_tracks
-            
+def get_similar_track(title: str, artist: str, lastfm_api_key: str, deadline: Optional[Deadline] = None):
+    cache_key = f"similar:{title}:{artist}"
+
+    def fetch():
+        params = {
+            "method": "track.getSimilar",
+            "artist": artist,
+            "track": title,
+            "api_key": lastfm_api_key,
+            "format": "json",
+            "limit": 5
+        }
+        response = LASTFM.get(LASTFM_API_URL, deadline=deadline, params=params)
+        if response.status_code != 200:
             return None
-            
-        except Exception as e:
-            print(f"[LASTFM-SIMILAR] Tentativo {attempt+1}/{max_retries} fallito per '{title}': {e}")
-            if attempt < max_retries - 1:
-                time.sleep(0.5)
-    return None
+
+        similar_tracks = response.json().get("similartracks", {}).get("track", [])
+
+        # Prendi il primo risultato
+        if isinstance(similar_tracks, list) and len(similar_tracks) > 0:
+            track = similar_tracks[0]
+            track["image_url"] = _extract_lastfm_image(track)
+            return track
+        elif similar_tracks:
+            similar_tracks["image_url"] = None
+            return similar_tracks
+        return None
+
+    try:
+        return _cached_call(_lastfm_cache, cache_key, fetch)
+    except Exception as e:
+        print(f"[LASTFM-SIMILAR] Ricerca fallita per '{title}': {e}")
+        return None
 
 # Raccomandazione per un singolo mood con strategie multiple e fallback
-def fetch_mood_recommendation(mood_id: int, mood_name: str, df: pd.DataFrame, lastfm_api_key: str, already_recommended: Set[str]) -> Dict:
+def fetch_mood_recommendation(mood_id: int, mood_name: str, df: pd.DataFrame, lastfm_api_key: str, already_recommended: Set[str],
+                              deadline: Optional[Deadline] = None) -> Dict:
     recommendations = {}
     
     # Tracce nel playlist con questo mood
@@ -207,7 +217,7 @@ def fetch_mood_recommendation(mood_id: int, mood_name: str, df: pd.DataFrame, la
         title = first_track["title"]
         artist = first_track["artist"]
         
-        similar_track = get_similar_track(title, artist, lastfm_api_key)
+        similar_track = get_similar_track(title, artist, lastfm_api_key, deadline)
         
         if similar_track:
             track_name = similar_track.get('name', '')
@@ -215,7 +225,7 @@ def fetch_mood_recommendation(mood_id: int, mood_name: str, df: pd.DataFrame, la
             if isinstance(artist_name, dict):
                 artist_name = artist_name.get('name', '')
             
-            image_url = get_track_image_from_deezer(track_name, artist_name)
+            image_url = get_track_image_from_deezer(track_name, artist_name, deadline)
             
             track_key = f"{track_name} - {artist_name}".lower()
             
@@ -231,7 +241,7 @@ def fetch_mood_recommendation(mood_id: int, mood_name: str, df: pd.DataFrame, la
     
     # Ricerca per keyword nel caso in cui la prima non riuscisse
     keyword = MOOD_SEARCH_KEYWORDS.get(mood_id, mood_name)
-    tracks = search_lastfm_track(keyword, lastfm_api_key, limit=5)
+    tracks = search_lastfm_track(keyword, lastfm_api_key, limit=5, deadline=deadline)
     
     if tracks and len(tracks) > 0:
         track = tracks[0]
@@ -241,7 +251,7 @@ def fetch_mood_recommendation(mood_id: int, mood_name: str, df: pd.DataFrame, la
         
         if track_key and track_key not in already_recommended:
             # Cerca immagine su Deezer
-            image_url = get_track_image_from_deezer(track_name, artist_name)
+            image_url = get_track_image_from_deezer(track_name, artist_name, deadline)
             
             recommendations[mood_name] = {
                 "track": track_name,
@@ -262,43 +272,59 @@ def fetch_mood_recommendation(mood_id: int, mood_name: str, df: pd.DataFrame, la
     
     return recommendations
 
-# Ricerca raccomandazioni per tutti i 4 mood in parallelo.
-def get_similar_songs_by_mood(csv_with_features: str, lastfm_api_key: str = "481d0ece35e3d695d07d399427f5ef04"):
-    from concurrent.futures import ThreadPoolExecutor, as_completed
-    
-    if not lastfm_api_key:
-        import os
-        lastfm_api_key = os.getenv("LASTFM_API_KEY", "481d0ece35e3d695d07d399427f5ef04")
-    
-    # Leggi il CSV con i mood
-    try:
-        df = pd.read_csv(csv_with_features)
-        mood_counts = df["label"].value_counts().sort_index().to_dict()
-    except Exception as e:
-        return FALLBACK_RECOMMENDATIONS.copy()
-    
-    already_recommended = set()
+# Ricerca raccomandazioni per i mood indicati in parallelo.
+# already_recommended contiene le tracce già proposte per altri mood, da non ripetere.
+# Se Last.fm o Deezer sono in difficoltà, allo scadere della deadline i mood
+# ancora in attesa ricevono il fallback; con i servizi sani si attendono tutti.
+def recommend_for_moods(df: pd.DataFrame, mood_ids, lastfm_api_key: str, already_recommended: Set[str] = None,
+                        deadline: Optional[Deadline] = None) -> Dict:
+    if already_recommended is None:
+        already_recommended = set()
+    deadline = deadline or Deadline()
     recommendations = {}
     
     #  Ricerca per ogni mood in parallelo
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        tasks = {
-            executor.submit(fetch_mood_recommendation, mood_id, MOOD_LABELS[mood_id], df, lastfm_api_key, already_recommended): mood_id
-            for mood_id in range(4)
-        }
-        
-        # Raccogliamo risultati
-        for future in as_completed(tasks):
+    executor = ThreadPoolExecutor(max_workers=4)
+    tasks = {
+        executor.submit(fetch_mood_recommendation, mood_id, MOOD_LABELS[mood_id], df, lastfm_api_key, already_recommended, deadline): mood_id
+        for mood_id in mood_ids
+    }
+    
+    # Raccogliamo risultati
+    timeout = deadline.remaining() if LASTFM.degraded() or DEEZER.degraded() else None
+    try:
+        for future in as_completed(tasks, timeout=timeout):
             try:
-                result = future.result(timeout=10)
+                result = future.result()
                 if result:
                     recommendations.update(result)
             except Exception as e:
                 print(f"[REC] Errore thread: {e}")
+    except TimeoutError:
+        print("[REC] Budget di tempo esaurito, uso il fallback per i mood mancanti")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
     
     # Aggiunta di mood mancanti con fallback
-    for mood_id, mood_name in MOOD_LABELS.items():
+    for mood_id in mood_ids:
+        mood_name = MOOD_LABELS[mood_id]
         if mood_name not in recommendations:
             recommendations[mood_name] = FALLBACK_RECOMMENDATIONS[mood_name]
     
     return recommendations
+
+
+# Ricerca raccomandazioni per tutti i 4 mood in parallelo.
+def get_similar_songs_by_mood(csv_with_features: str, lastfm_api_key: str = LASTFM_API_KEY,
+                              deadline: Optional[Deadline] = None):
+    if not lastfm_api_key:
+        lastfm_api_key = LASTFM_API_KEY
+    
+    # Leggi il CSV con i mood
+    try:
+        df = pd.read_csv(csv_with_features)
+        mood_counts = df["label"].value_counts().sort_index().to_dict()
+    except Exception as e:
+        return FALLBACK_RECOMMENDATIONS.copy()
+    
+    return recommend_for_moods(df, list(MOOD_LABELS), lastfm_api_key, deadline=deadline)
@@ -0,0 +1,355 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, Optional
+
+import requests
+
+from shared_cache import SharedCache
+
+# ==============================
+# DEADLINE PER RICHIESTA
+# ==============================
+
+# Ogni richiesta a /process-playlist ha un budget di tempo complessivo, diviso
+# tra gli step della pipeline: REQUEST_BUDGET più TRACK_BUDGET per ogni traccia
+# da elaborare, così una playlist lunga con i servizi sani arriva in fondo.
+# Gli step in sottoprocesso ricevono la propria scadenza (timestamp assoluto)
+# tramite questa variabile d'ambiente e vengono terminati poco dopo.
+# Dentro lo step la scadenza taglia solo le chiamate verso provider in
+# difficoltà (falliti o rallentati), che finiscono tra le tracce scartate.
+DEADLINE_ENV = "PLAYMOODIFY_DEADLINE"
+REQUEST_BUDGET = float(os.getenv("REQUEST_BUDGET", "30"))
+TRACK_BUDGET = float(os.getenv("TRACK_BUDGET", "0.5"))
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    def __init__(self, at: Optional[float] = None):
+        self.at = at
+
+    @classmethod
+    def after(cls, seconds: float) -> "Deadline":
+        return cls(time.time() + seconds)
+
+    # Scadenza ereditata dal processo padre, se presente
+    @classmethod
+    def from_env(cls) -> "Deadline":
+        value = os.getenv(DEADLINE_ENV)
+        return cls(float(value) if value else None)
+
+    def remaining(self) -> Optional[float]:
+        if self.at is None:
+            return None
+        return max(0.0, self.at - time.time())
+
+    def expired(self) -> bool:
+        return self.at is not None and time.time() >= self.at
+
+    # Timeout di una chiamata: il default, ridotto al tempo residuo
+    def timeout(self, default: float) -> float:
+        remaining = self.remaining()
+        if remaining is None:
+            return default
+        if remaining <= 0:
+            raise DeadlineExceeded("budget di tempo della richiesta esaurito")
+        return min(default, remaining)
+
+    # Stessa scadenza spostata in avanti, ad esempio quando si conosce il numero di tracce
+    def extended(self, seconds: float) -> "Deadline":
+        return Deadline(self.at + seconds if self.at is not None else None)
+
+    # Scadenza di uno step: una quota del tempo residuo, mai oltre quella della richiesta
+    def stage(self, share: float) -> "Deadline":
+        remaining = self.remaining()
+        if remaining is None:
+            return Deadline()
+        return Deadline(time.time() + remaining * share)
+
+    def env(self) -> Dict[str, str]:
+        return {DEADLINE_ENV: repr(self.at)} if self.at is not None else {}
+
+# ==============================
+# CIRCUIT BREAKER
+# ==============================
+
+# Lo stato dei breaker è nella cache SQLite condivisa: se SoundCharts va giù,
+# anche gli step in sottoprocesso e gli altri worker smettono subito di chiamarlo.
+_breaker_state = SharedCache("circuit_breaker")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_ratio: float = 0.5, min_calls: int = 10, window: float = 30.0,
+                 reset_timeout: float = 30.0, probe_timeout: float = 5.0):
+        self.name = name
+        self.failure_ratio = failure_ratio
+        self.min_calls = min_calls
+        self.window = window
+        self.reset_timeout = reset_timeout
+        self.probe_timeout = probe_timeout
+
+        # Esiti recenti di questo processo: (timestamp, fallita). Solo le
+        # transizioni di stato vengono scritte nella cache condivisa.
+        self._calls = deque()
+        self._lock = threading.Lock()
+
+    def _state(self) -> Dict:
+        return _breaker_state.get(self.name) or {"state": CLOSED}
+
+    def state(self) -> str:
+        return self._state()["state"]
+
+    # Decide se una chiamata può partire. Dopo reset_timeout un solo processo
+    # alla volta fa da sonda (half-open); se la sonda non risponde entro
+    # probe_timeout ne può partire un'altra.
+    def allow(self) -> bool:
+        state = self._state()
+        now = time.time()
+
+        if state["state"] == CLOSED:
+            return True
+        if state["state"] == OPEN and now - state["opened_at"] < self.reset_timeout:
+            return False
+        if state["state"] == HALF_OPEN and now - state["probe_at"] < self.probe_timeout:
+            return False
+
+        _breaker_state.set(self.name, dict(state, state=HALF_OPEN, probe_at=now))
+        return True
+
+    def _open(self, reason: str):
+        print(f"[CIRCUIT] {self.name}: aperto ({reason})")
+        _breaker_state.set(self.name, {"state": OPEN, "opened_at": time.time()})
+        self._calls.clear()
+
+    # Registra l'esito in finestra e ritorna (chiamate, fallite) degli ultimi `window` secondi
+    def _record(self, failed: bool):
+        now = time.time()
+        self._calls.append((now, failed))
+        while self._calls and now - self._calls[0][0] > self.window:
+            self._calls.popleft()
+        return len(self._calls), sum(1 for _, f in self._calls if f)
+
+    # Servizio in difficoltà: breaker non chiuso, segnalato lento da un processo
+    # nell'ultima finestra, oppure in questo processo almeno metà della soglia
+    # di apertura delle chiamate recenti è fallita
+    def degraded(self) -> bool:
+        state = self._state()
+        now = time.time()
+        if state["state"] != CLOSED or now - state.get("degraded_at", 0) < self.window:
+            return True
+        with self._lock:
+            recent = [failed for t, failed in self._calls if now - t <= self.window]
+        return len(recent) >= self.min_calls // 2 and sum(recent) / len(recent) >= self.failure_ratio / 2
+
+    # Un servizio lento non fallisce ma va trattato come in difficoltà: lo
+    # segnaliamo nella cache condivisa, al più una volta ogni mezza finestra
+    def mark_degraded(self, reason: str):
+        state = self._state()
+        if state["state"] == CLOSED and time.time() - state.get("degraded_at", 0) > self.window / 2:
+            print(f"[CIRCUIT] {self.name}: rallentato ({reason})")
+            _breaker_state.set(self.name, dict(state, degraded_at=time.time()))
+
+    def record_success(self):
+        with self._lock:
+            self._record(False)
+            if self._state()["state"] != CLOSED:
+                print(f"[CIRCUIT] {self.name}: chiuso")
+                _breaker_state.set(self.name, {"state": CLOSED})
+                self._calls.clear()
+
+    def record_failure(self):
+        with self._lock:
+            calls, failures = self._record(True)
+            state = self._state()["state"]
+            if state == HALF_OPEN:
+                self._open("sonda fallita")
+            elif state == CLOSED and calls >= self.min_calls and failures / calls >= self.failure_ratio:
+                self._open(f"{failures}/{calls} chiamate fallite")
+
+# ==============================
+# PROVIDER ESTERNI CON HEDGING
+# ==============================
+
+# Thread che possono chiamare un provider nello stesso processo: fino a 40
+# richieste sincrone di FastAPI, ognuna con 4 thread per le raccomandazioni
+# (gli step in sottoprocesso ne usano al più 8)
+MAX_PROVIDER_CALLERS = int(os.getenv("MAX_PROVIDER_CALLERS", "160"))
+
+# Pool condiviso per le richieste hedged: due posti (richiesta e hedge) per
+# ogni chiamante, così nessuna richiesta resta in coda dietro alle altre.
+# I thread vengono creati solo quando non ce n'è uno libero.
+HEDGE_POOL_SIZE = 2 * MAX_PROVIDER_CALLERS
+_hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_POOL_SIZE)
+
+
+# Dopo un fork il pool del padre non ha thread nel figlio
+def _reset_executor():
+    global _hedge_executor
+    _hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_POOL_SIZE)
+
+
+os.register_at_fork(after_in_child=_reset_executor)
+
+
+# Errori che indicano un servizio in difficoltà (non una risposta legittima come un 404)
+def _is_failure(response: requests.Response) -> bool:
+    return response.status_code >= 500 or response.status_code == 429
+
+
+# Chiamate recenti su cui si valuta se un servizio è rallentato
+SLOW_SAMPLES = 20
+
+
+class Provider:
+    def __init__(self, name: str, timeout: float, hedge_min_delay: float = 0.2,
+                 hedge_ratio: float = 0.1, slow_latency: Optional[float] = None,
+                 max_timeouts: int = 2, **breaker_options):
+        self.name = name
+        self.timeout = timeout
+        self.breaker = CircuitBreaker(name, probe_timeout=timeout, **breaker_options)
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_ratio = hedge_ratio
+
+        # Il servizio è rallentato se il p95 recente supera slow_latency o se
+        # nella finestra del breaker scadono almeno max_timeouts chiamate
+        self.slow_latency = slow_latency if slow_latency is not None else timeout / 2
+        self.max_timeouts = max_timeouts
+
+        # Latenze recenti di questo processo, per stimare quando una richiesta è "lenta"
+        self._latencies = deque(maxlen=200)
+        self._timeouts = deque()
+        self._requests = 0
+        self._hedges = 0
+        self._lock = threading.Lock()
+
+    # Ritardo dopo cui parte la seconda richiesta: il p95 delle latenze recenti
+    def hedge_delay(self) -> float:
+        with self._lock:
+            latencies = sorted(self._latencies)
+        if len(latencies) < 20:
+            return max(self.hedge_min_delay, self.timeout / 2)
+        return max(self.hedge_min_delay, latencies[int(len(latencies) * 0.95) - 1])
+
+    # Al più hedge_ratio delle richieste viene duplicato, così durante un
+    # rallentamento generale non raddoppiamo il carico sul servizio
+    def _take_hedge(self) -> bool:
+        with self._lock:
+            if self._hedges + 1 > self.hedge_ratio * self._requests + 1:
+                return False
+            self._hedges += 1
+            return True
+
+    def _timed_get(self, url: str, timeout: float, kwargs: Dict,
+                   started: Optional[threading.Event] = None) -> requests.Response:
+        if started is not None:
+            started.set()
+        start = time.perf_counter()
+        response = requests.get(url, timeout=timeout, **kwargs)
+        if not _is_failure(response):
+            with self._lock:
+                self._latencies.append(time.perf_counter() - start)
+        return response
+
+    def degraded(self) -> bool:
+        return self.breaker.degraded()
+
+    def _check_slow(self, timed_out: bool):
+        now = time.time()
+        with self._lock:
+            if timed_out:
+                self._timeouts.append(now)
+            while self._timeouts and now - self._timeouts[0] > self.breaker.window:
+                self._timeouts.popleft()
+            timeouts = len(self._timeouts)
+            recent = sorted(list(self._latencies)[-SLOW_SAMPLES:])
+        p95 = recent[int(len(recent) * 0.95) - 1] if len(recent) >= 5 else 0.0
+
+        if timeouts >= self.max_timeouts:
+            self.breaker.mark_degraded(f"{timeouts} timeout")
+        elif p95 >= self.slow_latency:
+            self.breaker.mark_degraded(f"p95 {p95:.2f}s")
+
+    # GET verso il provider. Fallisce subito con CircuitOpenError se il breaker
+    # è aperto e, se il servizio è in difficoltà, con DeadlineExceeded quando
+    # il budget della richiesta è finito.
+    # Se la prima richiesta è più lenta del solito ne parte una seconda e vince
+    # la prima risposta valida.
+    def get(self, url: str, deadline: Optional[Deadline] = None, **kwargs) -> requests.Response:
+        deadline = deadline or Deadline.from_env()
+        timeout = deadline.timeout(self.timeout) if self.degraded() else self.timeout
+
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"{self.name} non disponibile (circuit breaker aperto)")
+
+        with self._lock:
+            self._requests += 1
+
+        try:
+            response = self._hedged_get(url, timeout, kwargs)
+        except Exception as e:
+            self.breaker.record_failure()
+            self._check_slow(isinstance(e, requests.Timeout))
+            raise
+
+        self._check_slow(False)
+
+        if _is_failure(response):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def _hedged_get(self, url: str, timeout: float, kwargs: Dict) -> requests.Response:
+        delay = self.hedge_delay()
+
+        # Niente hedging se non c'è tempo per una seconda richiesta utile
+        if delay >= timeout:
+            return self._timed_get(url, timeout, kwargs)
+
+        # Il ritardo dell'hedge si conta da quando la richiesta parte davvero,
+        # non da quando entra nel pool
+        started = threading.Event()
+        primary = _hedge_executor.submit(self._timed_get, url, timeout, kwargs, started)
+        started.wait()
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._take_hedge():
+            return primary.result()
+
+        hedge = _hedge_executor.submit(self._timed_get, url, timeout - delay, kwargs)
+        pending = {primary, hedge}
+        result, error = None, None
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    response = future.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                if not _is_failure(response):
+                    return response
+                result = result or response
+
+        if result is not None:
+            return result
+        raise error
+
+
+# Un provider per servizio esterno: il nome identifica il breaker condiviso
+SOUNDCHARTS = Provider("soundcharts", timeout=2)
+LASTFM = Provider("lastfm", timeout=3)
+DEEZER = Provider("deezer", timeout=3)
@@ -0,0 +1,138 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# ==============================
+# CACHE CONDIVISA SU SQLITE
+# ==============================
+
+# Gli step della pipeline girano in processi separati: una cache su SQLite in
+# modalità WAL è condivisa da tutti i processi e sopravvive tra le esecuzioni.
+CACHE_PATH = os.getenv(
+    "PLAYMOODIFY_CACHE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache.db")
+)
+
+_local = threading.local()
+
+
+# Dopo un fork (worker gunicorn con preload) il figlio apre connessioni proprie
+def _reset_connections():
+    global _local
+    _local = threading.local()
+
+
+os.register_at_fork(after_in_child=_reset_connections)
+
+
+# Una connessione per thread: sqlite3 non condivide le connessioni tra thread
+def _connect(path: str) -> sqlite3.Connection:
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+
+    conn = connections.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "namespace TEXT, key TEXT, value TEXT, updated_at REAL, "
+            "PRIMARY KEY (namespace, key))"
+        )
+        conn.commit()
+        connections[path] = conn
+    return conn
+
+
+class SharedCache:
+    def __init__(self, namespace: str, ttl: Optional[float] = None, path: Optional[str] = None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.path = path or CACHE_PATH
+
+    # Ritorna (valore, timestamp di aggiornamento) anche se scaduto, o None
+    def get_entry(self, key: str) -> Optional[Tuple[Any, float]]:
+        row = _connect(self.path).execute(
+            "SELECT value, updated_at FROM cache WHERE namespace = ? AND key = ?",
+            (self.namespace, key)
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        entry = self.get_entry(key)
+        if entry is None:
+            return default
+        value, updated_at = entry
+        if self.ttl is not None and time.time() - updated_at > self.ttl:
+            return default
+        return value
+
+    def set(self, key: str, value: Any):
+        conn = _connect(self.path)
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)",
+            (self.namespace, key, json.dumps(value), time.time())
+        )
+        conn.commit()
+
+    # Lettura di più chiavi con una sola query; le chiavi assenti o scadute sono omesse
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Any]:
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        conn = _connect(self.path)
+        now = time.time()
+
+        # SQLite limita il numero di parametri per query
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = conn.execute(
+                f"SELECT key, value, updated_at FROM cache WHERE namespace = ? "
+                f"AND key IN ({','.join('?' * len(chunk))})",
+                (self.namespace, *chunk)
+            )
+            for key, value, updated_at in rows:
+                if self.ttl is None or now - updated_at <= self.ttl:
+                    found[key] = json.loads(value)
+        return found
+
+    def set_many(self, items: Dict[str, Any]):
+        if not items:
+            return
+        now = time.time()
+        conn = _connect(self.path)
+        conn.executemany(
+            "INSERT OR REPLACE INTO cache (namespace, key, value, updated_at) VALUES (?, ?, ?, ?)",
+            [(self.namespace, key, json.dumps(value), now) for key, value in items.items()]
+        )
+        conn.commit()
+
+    # Valori più recenti del namespace (non scaduti), al massimo limit
+    def recent_values(self, limit: int) -> List[Any]:
+        oldest = time.time() - self.ttl if self.ttl is not None else 0.0
+        rows = _connect(self.path).execute(
+            "SELECT value FROM cache WHERE namespace = ? AND updated_at >= ? "
+            "ORDER BY updated_at DESC LIMIT ?",
+            (self.namespace, oldest, limit)
+        )
+        return [json.loads(value) for value, in rows]
+
+    # Segna una voce come ancora valida senza riscriverne il valore
+    def touch(self, key: str):
+        conn = _connect(self.path)
+        conn.execute(
+            "UPDATE cache SET updated_at = ? WHERE namespace = ? AND key = ?",
+            (time.time(), self.namespace, key)
+        )
+        conn.commit()
+
+    def delete(self, key: str):
+        conn = _connect(self.path)
+        conn.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (self.namespace, key))
+        conn.commit()
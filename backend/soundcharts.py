@@ -1,56 +1,70 @@
-import requests
 import sys
+import time
 import pandas as pd
 import csv
 from typing import Optional, Dict, List
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
 from dotenv import load_dotenv
 from pathlib import Path
 
+from shared_cache import SharedCache
+from pipeline_utils import ordered_map, STATUS_RESOLVED, STATUS_NOT_FOUND, STATUS_FEATURE_MISSING, STATUS_ERROR
+from resilience import SOUNDCHARTS
+
 env_path = Path(__file__).parent.parent / '.env'
 load_dotenv(dotenv_path=env_path)
 
+SOUNDCHARTS_API_URL = os.getenv("SOUNDCHARTS_API_URL", "https://customer.api.soundcharts.com")
+
+# Le feature di una traccia cambiano di rado: le condividiamo tra processi per 30 giorni
+_features_cache = SharedCache("features", ttl=30 * 24 * 3600)
+
 # ==============================
 # API SOUNDCHARTS
 # ==============================
 
 # Recuperiamo le feature audio da SoundCharts API usando l'UUID della traccia.
-def get_audio_features_by_uuid(uuid: str) -> Optional[Dict]:
-    
-    try:
-        url = f"https://customer.api.soundcharts.com/api/v2.25/song/{uuid}"
+# Solleva un'eccezione in caso di errore di rete o HTTP, None se l'audio non è disponibile.
+def fetch_audio_features(uuid: str) -> Optional[Dict]:
+    url = f"{SOUNDCHARTS_API_URL}/api/v2.25/song/{uuid}"
 
-        headers = {
-            'x-app-id': os.getenv('X_APP_ID_FEATURE'),
-            'x-api-key': os.getenv('X_API_KEY_FEATURE'),
-        }
+    headers = {
+        'x-app-id': os.getenv('X_APP_ID_FEATURE'),
+        'x-api-key': os.getenv('X_API_KEY_FEATURE'),
+    }
 
-        response = requests.get(url, headers=headers, timeout=2)
+    response = SOUNDCHARTS.get(url, headers=headers)
 
-        if response.status_code != 200:
-            return None
+    # Un 404 significa che SoundCharts non ha la traccia, non un guasto del servizio
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
 
-        data = response.json()
+    data = response.json()
 
-        # Estraiamo le feature audio
-        audio = data.get("object", {}).get("audio")
-        if not audio:
-            return None
+    # Estraiamo le feature audio
+    audio = data.get("object", {}).get("audio")
+    if not audio:
+        return None
+
+    features = {
+        "danceability": audio.get("danceability"),
+        "energy": audio.get("energy"),
+        "speechiness": audio.get("speechiness"),
+        "acousticness": audio.get("acousticness"),
+        "instrumentalness": audio.get("instrumentalness"),
+        "liveness": audio.get("liveness"),
+        "valence": audio.get("valence"),
+        "tempo": audio.get("tempo")
+    }
 
-        features = {
-            "danceability": audio.get("danceability"),
-            "energy": audio.get("energy"),
-            "speechiness": audio.get("speechiness"),
-            "acousticness": audio.get("acousticness"),
-            "instrumentalness": audio.get("instrumentalness"),
-            "liveness": audio.get("liveness"),
-            "valence": audio.get("valence"),
-            "tempo": audio.get("tempo")
-        }
+    return features
 
-        return features
 
+# Come fetch_audio_features, ma ritorna None anche in caso di errore
+def get_audio_features_by_uuid(uuid: str) -> Optional[Dict]:
+    try:
+        return fetch_audio_features(uuid)
     except Exception as e:
         print(f"Errore recupero feature UUID {uuid}: {e}")
         return None
@@ -59,28 +73,59 @@ def get_audio_features_by_uuid(uuid: str) -> Optional[Dict]:
 # CSV PROCESSOR
 # ==============================
 
-# Elaboriamo una singola riga del CSV per recuperare le feature audio
-def process_single_uuid(row: Dict, index: int) -> Optional[Dict]:
+FIELDNAMES = [
+    "position", "title", "artist", "uuid", "status",
+    "danceability", "energy", "speechiness", "acousticness",
+    "instrumentalness", "liveness", "valence", "tempo"
+]
+
+# Elaboriamo una singola riga del CSV per recuperare le feature audio.
+# Le righe senza feature restano nel risultato con il relativo stato.
+def process_single_uuid(row: Dict, index: int) -> Dict:
     title = row.get('title', '').strip()
     artist = row.get('artist', '').strip()
     uuid = row.get('uuid', '').strip()
+    status = row.get('status', '').strip()
     
-    # Saltiamo la riga se l'UUID è mancante
+    result = {
+        "position": row.get('position') or index,
+        "title": title,
+        "artist": artist,
+        "uuid": uuid,
+        "status": status or STATUS_RESOLVED
+    }
+
+    # Saltiamo la ricerca se l'UUID è mancante, mantenendo lo stato a monte
     if not uuid or uuid == 'N/A':
-        return None
+        if result["status"] == STATUS_RESOLVED:
+            result["status"] = STATUS_NOT_FOUND
+        return result
     
-    features = get_audio_features_by_uuid(uuid)
+    cached = _features_cache.get_entry(uuid)
+    features = None
+    if cached is not None and time.time() - cached[1] <= _features_cache.ttl:
+        features = cached[0]
+
+    if features is None:
+        try:
+            features = fetch_audio_features(uuid)
+        except Exception as e:
+            # Con SoundCharts non disponibile va bene anche una voce di cache scaduta
+            if cached is None:
+                print(f"Errore recupero feature UUID {uuid}: {e}")
+                result["status"] = STATUS_ERROR
+                return result
+            features = cached[0]
+        else:
+            if features:
+                _features_cache.set(uuid, features)
     
     if not features:
-        return None
+        result["status"] = STATUS_FEATURE_MISSING
+        return result
     
     # Aggiungiamo le feature al risultato
-    result = {
-        "title": title,
-        "artist": artist,
-        "uuid": uuid,
-        **features
-    }
+    result.update(features)
     
     return result
 
@@ -92,29 +137,16 @@ def process_csv_and_get_audio_features(csv_file_path: str, output_file_path: str
         reader = csv.DictReader(infile)
         rows = list(reader)
     
-    results = []
-    
-    # Elaboriamo le tracce in parallelo con 8 worker
-    with ThreadPoolExecutor(max_workers=8) as executor:
-        tasks = [
-            executor.submit(process_single_uuid, row, i + 1)
-            for i, row in enumerate(rows)
-        ]
-        
-        for future in as_completed(tasks):
-            result = future.result()
-            if result:
-                results.append(result)
+    # Elaboriamo le tracce in parallelo con 8 worker mantenendo l'ordine della playlist
+    results = list(ordered_map(
+        lambda item: process_single_uuid(item[1], item[0] + 1),
+        enumerate(rows),
+        max_workers=8
+    ))
     
     # Scriviamo i risultati nel CSV di output
-    fieldnames = [
-        "title", "artist", "uuid",
-        "danceability", "energy", "speechiness", "acousticness",
-        "instrumentalness", "liveness", "valence", "tempo"
-    ]
-
     with open(output_file_path, 'w', newline='', encoding='utf-8') as outfile:
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
+        writer = csv.DictWriter(outfile, fieldnames=FIELDNAMES)
         writer.writeheader()
         if results:
             writer.writerows(results)
@@ -0,0 +1,27 @@
+from track_index import TrackIndex, match_score, normalize_text, REMOTE_MATCH_THRESHOLD
+
+
+def test_normalize_keeps_non_latin_scripts():
+    assert normalize_text("夜に駆ける") == "夜に駆ける"
+    assert normalize_text("Группа Крови!") == "группа крови"
+    assert normalize_text("Beyoncé") == "beyonce"
+
+
+def test_non_latin_titles_by_same_artist_do_not_collide(tmp_path):
+    index = TrackIndex(str(tmp_path / "index.db"))
+    index.add("夜に駆ける", "YOASOBI", "uuid-yoru")
+
+    assert index.lookup("夜に駆ける", "YOASOBI") == ("uuid-yoru", 1.0)
+    match = index.lookup("群青", "YOASOBI")
+    assert match is None or match[1] < REMOTE_MATCH_THRESHOLD
+
+
+def test_add_refuses_empty_title(tmp_path):
+    index = TrackIndex(str(tmp_path / "index.db"))
+    index.add("!!!", "YOASOBI", "uuid-x")
+    assert len(index) == 0
+
+
+def test_non_latin_exact_match_scores_high():
+    assert match_score("Группа крови", "Кино", "Группа крови", "Кино") > REMOTE_MATCH_THRESHOLD
+    assert match_score("群青", "YOASOBI", "夜に駆ける", "YOASOBI") < REMOTE_MATCH_THRESHOLD
@@ -0,0 +1,302 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import Counter
+from typing import Dict, List, Optional, Set, Tuple
+
+# ==============================
+# NORMALIZZAZIONE TITOLO / ARTISTA
+# ==============================
+
+TRACK_INDEX_PATH = os.getenv(
+    "TRACK_INDEX_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "track_index.db")
+)
+
+# Ogni quanti secondi l'indice rilegge le tracce aggiunte da altri processi
+REFRESH_INTERVAL = 1.0
+
+# Sopra questa soglia una corrispondenza locale evita la ricerca su SoundCharts
+LOCAL_MATCH_THRESHOLD = 0.92
+
+# Sotto questa soglia un risultato remoto è considerato un'altra canzone
+REMOTE_MATCH_THRESHOLD = 0.5
+
+# Parole che distinguono versioni diverse dello stesso brano
+VERSION_MARKERS = {
+    "remix", "mix", "live", "acoustic", "instrumental", "edit", "cover", "karaoke",
+    "demo", "unplugged", "rework", "extended", "radio", "sped", "slowed", "reprise"
+}
+
+_FEAT_RE = re.compile(r"[\(\[]\s*(feat|ft|featuring|with)\b\.?[^\)\]]*[\)\]]", re.IGNORECASE)
+_REMASTER_RE = re.compile(
+    r"\s-\s[^-]*\bremaster(ed)?\b.*$|[\(\[][^\)\]]*\bremaster(ed)?\b[^\)\]]*[\)\]]",
+    re.IGNORECASE
+)
+_ARTIST_SPLIT_RE = re.compile(r"\s*(?:,|&|;|/|\bfeat\b\.?|\bft\b\.?|\bfeaturing\b|\bvs\b\.?|\bx\b|\band\b|\bwith\b)\s*")
+
+
+# Gli accenti si tolgono solo dalle lettere latine ("Beyoncé" = "Beyonce"): per
+# altre scritture i segni diacritici distinguono parole diverse (か / が)
+def _is_latin(c: str) -> bool:
+    return c < "\u0250" or "\u1e00" <= c <= "\u1eff"
+
+
+# Lettere e cifre di qualsiasi scrittura, in minuscolo e senza punteggiatura
+def normalize_text(text: str) -> str:
+    chars = []
+    for c in unicodedata.normalize("NFKD", text or ""):
+        if unicodedata.combining(c) and chars and _is_latin(chars[-1]):
+            continue
+        chars.append(c)
+    text = unicodedata.normalize("NFC", "".join(chars)).casefold()
+    text = re.sub(r"[\W_]+", " ", text)
+    return text.strip()
+
+
+# Togliamo dal titolo i featuring e le diciture di remaster, che SoundCharts omette
+def normalize_title(title: str) -> str:
+    title = _FEAT_RE.sub(" ", title or "")
+    title = _REMASTER_RE.sub(" ", title)
+    return normalize_text(title)
+
+
+# Gli artisti arrivano come "A, B" da linktocsvconverter e come "A feat. B" da SoundCharts
+def normalize_artists(artist: str) -> Set[str]:
+    names = _ARTIST_SPLIT_RE.split((artist or "").lower())
+    return {n for n in (normalize_text(name) for name in names) if n}
+
+
+def make_key(title: str, artist: str) -> str:
+    return normalize_title(title) + "|" + ",".join(sorted(normalize_artists(artist)))
+
+# ==============================
+# SIMILARITÀ
+# ==============================
+
+def trigrams(text: str) -> Set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def dice(a: Set[str], b: Set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+def title_similarity(a: str, b: str) -> float:
+    tokens_a, tokens_b = set(a.split()), set(b.split())
+    score = 0.5 * dice(trigrams(a), trigrams(b)) + 0.5 * dice(tokens_a, tokens_b)
+
+    # Numeri e marcatori di versione devono coincidere: "Part 2" non è "Part 3"
+    # e un remix non è l'originale
+    if {t for t in tokens_a if t.isdigit()} != {t for t in tokens_b if t.isdigit()}:
+        score *= 0.5
+    if (tokens_a & VERSION_MARKERS) != (tokens_b & VERSION_MARKERS):
+        score *= 0.6
+    return score
+
+
+# Per i crediti multi-artista basta che un insieme sia contenuto nell'altro
+def artist_similarity(a: Set[str], b: Set[str]) -> Optional[float]:
+    if not a or not b:
+        return None
+
+    def coverage(src: Set[str], dst: Set[str]) -> float:
+        return sum(max(dice(trigrams(s), trigrams(d)) for d in dst) for s in src) / len(src)
+
+    return max(coverage(a, b), coverage(b, a))
+
+
+def _combine(t_sim: float, a_sim: Optional[float]) -> float:
+    # Senza artista da confrontare ci fidiamo meno del solo titolo
+    if a_sim is None:
+        return t_sim * 0.85
+    return 0.6 * t_sim + 0.4 * a_sim
+
+
+# Punteggio tra 0 e 1 tra una traccia cercata e un candidato
+def match_score(title: str, artist: str, candidate_title: str, candidate_artist: str) -> float:
+    return _combine(
+        title_similarity(normalize_title(title), normalize_title(candidate_title)),
+        artist_similarity(normalize_artists(artist), normalize_artists(candidate_artist))
+    )
+
+# ==============================
+# INDICE LOCALE
+# ==============================
+
+# Voci tenute nell'indice: oltre questo numero si eliminano le meno recenti,
+# così l'indice (e il tempo per caricarlo in ogni step della pipeline) non cresce senza limite
+MAX_ENTRIES = int(os.getenv("TRACK_INDEX_MAX_ENTRIES", "20000"))
+
+# Voci lette al massimo dalle liste dei trigrammi per trovare i candidati di una
+# ricerca: i trigrammi comuni ("lov", "ong") pesano quanto l'indice intero
+MAX_POSTINGS_SCANNED = 5000
+
+
+# Tracce già risolte, persistite su SQLite in modo che ogni esecuzione della
+# pipeline riparta da quanto imparato in precedenza. Le corrispondenze esatte
+# si leggono direttamente da SQLite; l'indice in memoria per la ricerca fuzzy
+# viene caricato solo alla prima ricerca che non ha una corrispondenza esatta.
+class TrackIndex:
+    def __init__(self, path: str = TRACK_INDEX_PATH, max_entries: int = MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: List[Tuple[str, Set[str], str]] = []
+        self._by_key: Dict[str, int] = {}
+        self._postings: Dict[str, List[int]] = {}
+        self._loaded = False
+        self._added = 0
+
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tracks ("
+            "key TEXT PRIMARY KEY, title TEXT, artist TEXT, uuid TEXT, updated_at REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS tracks_updated_at ON tracks (updated_at)")
+        self._conn.commit()
+
+        self._synced_until = 0.0
+        self._last_refresh = 0.0
+
+    # Carica le voci più recenti alla prima ricerca fuzzy
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            rows = self._conn.execute(
+                "SELECT key, title, artist, uuid, updated_at FROM tracks ORDER BY updated_at DESC LIMIT ?",
+                (self.max_entries,)
+            ).fetchall()
+            for key, title, artist, uuid, updated_at in reversed(rows):
+                self._insert(key, title, artist, uuid)
+                self._synced_until = max(self._synced_until, updated_at)
+            self._last_refresh = time.time()
+            self._loaded = True
+
+    # Carica le tracce scritte da altri processi (worker o step della pipeline)
+    def refresh(self):
+        if not self._loaded:
+            return
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT key, title, artist, uuid, updated_at FROM tracks WHERE updated_at >= ? ORDER BY updated_at",
+                (self._synced_until,)
+            ).fetchall()
+            for key, title, artist, uuid, updated_at in rows:
+                self._insert(key, title, artist, uuid)
+                self._synced_until = max(self._synced_until, updated_at)
+            self._last_refresh = time.time()
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+
+    def _insert(self, key: str, title: str, artist: str, uuid: str):
+        norm_title = normalize_title(title)
+        # Voci senza titolo normalizzato (scritte da versioni precedenti) collidono tra loro
+        if not norm_title or key.startswith("|"):
+            return
+        entry = (norm_title, normalize_artists(artist), uuid)
+
+        # Chiave già nota: aggiorniamo solo l'UUID associato
+        if key in self._by_key:
+            self._entries[self._by_key[key]] = entry
+            return
+
+        entry_id = len(self._entries)
+        self._by_key[key] = entry_id
+        self._entries.append(entry)
+        for gram in trigrams(norm_title):
+            self._postings.setdefault(gram, []).append(entry_id)
+
+    def _uuid_for_key(self, key: str) -> Optional[str]:
+        if self._loaded:
+            entry_id = self._by_key.get(key)
+            if entry_id is not None:
+                return self._entries[entry_id][2]
+        row = self._conn.execute("SELECT uuid FROM tracks WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, title: str, artist: str, uuid: str):
+        key = make_key(title, artist)
+        # Senza titolo la chiave sarebbe la stessa per tutte le canzoni dell'artista
+        if not uuid or key.startswith("|") or self._uuid_for_key(key) == uuid:
+            return
+        with self._lock:
+            if self._loaded:
+                self._insert(key, title, artist, uuid)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO tracks (key, title, artist, uuid, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (key, title, artist, uuid, time.time())
+            )
+            self._added += 1
+            # Ogni tanto eliminiamo le voci oltre il limite (le meno recenti)
+            if self._added % 100 == 0:
+                self._conn.execute(
+                    "DELETE FROM tracks WHERE updated_at < ("
+                    "SELECT updated_at FROM tracks ORDER BY updated_at DESC LIMIT 1 OFFSET ?)",
+                    (self.max_entries - 1,)
+                )
+            self._conn.commit()
+
+    # Ritorna (uuid, punteggio) della miglior corrispondenza locale, se esiste
+    def lookup(self, title: str, artist: str, max_candidates: int = 20) -> Optional[Tuple[str, float]]:
+        key = make_key(title, artist)
+        if not key.startswith("|"):
+            uuid = self._uuid_for_key(key)
+            if uuid:
+                return uuid, 1.0
+
+        self._ensure_loaded()
+        if time.time() - self._last_refresh > REFRESH_INTERVAL:
+            self.refresh()
+
+        norm_title = normalize_title(title)
+        norm_artists = normalize_artists(artist)
+
+        # Candidati: le voci che condividono più trigrammi con il titolo, partendo
+        # dai trigrammi più rari finché non si supera MAX_POSTINGS_SCANNED
+        postings = sorted((self._postings.get(gram, ()) for gram in trigrams(norm_title)), key=len)
+        shared = Counter()
+        scanned = 0
+        for ids in postings:
+            if scanned and scanned + len(ids) > MAX_POSTINGS_SCANNED:
+                break
+            shared.update(ids)
+            scanned += len(ids)
+        if not shared:
+            return None
+
+        best = None
+        for entry_id, _ in shared.most_common(max_candidates):
+            cand_title, cand_artists, cand_uuid = self._entries[entry_id]
+            score = _combine(
+                title_similarity(norm_title, cand_title),
+                artist_similarity(norm_artists, cand_artists)
+            )
+            if best is None or score > best[1]:
+                best = (cand_uuid, score)
+        return best
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+# Indice condiviso del processo, creato al primo utilizzo
+def get_track_index() -> TrackIndex:
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = TrackIndex()
+    return _index
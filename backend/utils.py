@@ -1,4 +1,6 @@
 import os
+import hashlib
+import shutil
 import joblib
 from huggingface_hub import hf_hub_download
 from dotenv import load_dotenv
@@ -12,20 +14,34 @@ load_dotenv()
 MODEL_REPO = "Alepnc04/PlayMoodifyModel"
 MODEL_FILE = "PlayMoodify.pkl"
 
+# Percorso di un modello locale da usare al posto di HuggingFace (deployment offline, benchmark)
+MODEL_PATH = os.environ.get("MODEL_PATH")
+
 _model = None
+_model_version = None
 
-# Carica il modello ML da HuggingFace Hub
+# Carica il modello ML da HuggingFace Hub.
+# Con gunicorn --preload viene caricato una sola volta nel master e condiviso
+# copy-on-write dai worker (vedi gunicorn.conf.py).
 def load_model():
-    global _model
+    global _model, _model_version
     if _model is None:
-        model_path = hf_hub_download(
+        model_path = MODEL_PATH or hf_hub_download(
             repo_id=MODEL_REPO,
             filename=MODEL_FILE,
             token=os.environ.get("HF_TOKEN")
         )
         _model = joblib.load(model_path)
+
+        # L'impronta del file identifica la versione del modello nelle cache condivise
+        with open(model_path, "rb") as f:
+            _model_version = hashlib.sha1(f.read()).hexdigest()[:16]
     return _model
 
+
+def get_model_version():
+    return _model_version
+
 # ==============================
 # FILE CLEANUP
 # ==============================
@@ -48,3 +64,11 @@ def cleanup_csv_files(base_dir: str = None):
                 os.remove(csv_file)
         except Exception as e:
             print(f"[CLEANUP] Error deleting {csv_file}: {e}")
+
+
+# Eliminiamo la cartella temporanea di una singola richiesta.
+def cleanup_work_dir(work_dir: str):
+    try:
+        shutil.rmtree(work_dir)
+    except Exception as e:
+        print(f"[CLEANUP] Error deleting {work_dir}: {e}")
@@ -1,55 +1,83 @@
-import requests
 import csv
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Tuple, Iterable
 from urllib.parse import quote
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
 from dotenv import load_dotenv
 from pathlib import Path
 
+from pipeline_utils import ordered_map, STATUS_RESOLVED, STATUS_NOT_FOUND, STATUS_ERROR
+from track_index import get_track_index, match_score, LOCAL_MATCH_THRESHOLD, REMOTE_MATCH_THRESHOLD
+from resilience import SOUNDCHARTS
+
 env_path = Path(__file__).parent.parent / '.env'
 load_dotenv(dotenv_path=env_path)
 
+SOUNDCHARTS_API_URL = os.getenv("SOUNDCHARTS_API_URL", "https://customer.api.soundcharts.com")
+
 # ==============================
 # API SOUNDCHARTS
 # ==============================
 
-# Ricerca l'UUID di una canzone tramite il titolo e l'artista su SoundCharts API
+# Ricerca una canzone tramite il titolo e l'artista su SoundCharts API.
+# Solleva un'eccezione in caso di errore di rete o HTTP.
+def search_soundcharts_candidates(song_name: str, artist_name: Optional[str] = None) -> List[Dict]:
+    query = song_name
+    if artist_name:
+        query = f"{song_name} {artist_name}"
+    
+    # Correggiamo l'encoding della query per URL
+    encoded_query = quote(query)
+    
+    url = f"{SOUNDCHARTS_API_URL}/api/v2/song/search/{encoded_query}"
+    
+    headers = {
+        'x-app-id': os.getenv('X_APP_ID_UUID'),
+        'x-api-key': os.getenv('X_API_KEY_UUID'),
+    }
+
+    params = {
+        'offset': '0',
+        'limit': '20',
+    }
+    
+    response = SOUNDCHARTS.get(url, headers=headers, params=params)
+    response.raise_for_status()
+
+    data = response.json()
+    return (data or {}).get("items") or []
+
+
+# Sceglie tra i risultati remoti quello più simile alla traccia cercata.
+# Ritorna (uuid, punteggio) oppure None se nessun risultato è abbastanza simile.
+def best_soundcharts_match(song_name: str, artist_name: Optional[str], items: List[Dict]) -> Optional[Tuple[str, float]]:
+    scored = [
+        (item.get("uuid"), match_score(song_name, artist_name or "", item.get("name", ""), item.get("creditName", "")))
+        for item in items
+        if item.get("uuid")
+    ]
+    if not scored:
+        return None
+
+    # Risultati senza nome (vecchio formato API): ci affidiamo all'ordine di SoundCharts
+    if not any(item.get("name") for item in items):
+        return scored[0][0], 0.0
+
+    uuid, score = max(scored, key=lambda s: s[1])
+    if score < REMOTE_MATCH_THRESHOLD:
+        return None
+    return uuid, score
+
+
+# Ricerca l'UUID di una canzone. Solleva un'eccezione in caso di errore di rete o HTTP.
+def search_uuid_on_soundcharts(song_name: str, artist_name: Optional[str] = None) -> Optional[str]:
+    match = best_soundcharts_match(song_name, artist_name, search_soundcharts_candidates(song_name, artist_name))
+    return match[0] if match else None
+
+
+# Come search_uuid_on_soundcharts, ma ritorna None anche in caso di errore
 def get_uuid_from_soundcharts(song_name: str, artist_name: Optional[str] = None) -> Optional[str]:
     try:
-        query = song_name
-        if artist_name:
-            query = f"{song_name} {artist_name}"
-        
-        # Correggiamo l'encoding della query per URL
-        encoded_query = quote(query)
-        
-        url = f"https://customer.api.soundcharts.com/api/v2/song/search/{encoded_query}"
-        
-        headers = {
-            'x-app-id': os.getenv('X_APP_ID_UUID'),
-            'x-api-key': os.getenv('X_API_KEY_UUID'),
-        }
-
-        params = {
-            'offset': '0',
-            'limit': '20',
-        }
-        
-        response = requests.get(url, headers=headers, params=params, timeout=2)
-        
-        if response.status_code == 200:
-            data = response.json()
-            
-            # Estrai l'UUID dal primo risultato
-            if data and "items" in data and len(data["items"]) > 0:
-                uuid = data["items"][0].get("uuid")
-                return uuid
-            else:
-                return None
-        else:
-            return None
-            
+        return search_uuid_on_soundcharts(song_name, artist_name)
     except Exception as e:
         print(f"Errore nella ricerca: {e}")
         return None
@@ -58,71 +86,116 @@ def get_uuid_from_soundcharts(song_name: str, artist_name: Optional[str] = None)
 # CSV PROCESSOR
 # ==============================
 
-# Elabora una singola traccia e cerca l'UUID
-def process_single_track(row: Dict) -> Optional[Dict[str, str]]:
+# Elabora una singola traccia e cerca l'UUID, prima nell'indice locale e poi su SoundCharts
+def process_single_track(row: Dict, index: int) -> Dict[str, str]:
     
     title = row.get('title', '').strip()
     artist = row.get('artist', '').strip()
     
-    if not title:
-        return None
-    
-    uuid = get_uuid_from_soundcharts(title, artist)
-    
-    return {
+    result = {
+        'position': index,
         'title': title,
         'artist': artist,
-        'uuid': uuid if uuid else 'N/A'
+        'uuid': 'N/A',
+        'status': STATUS_NOT_FOUND,
+        'match_source': '',
+        'match_score': ''
     }
 
+    if not title:
+        return result
+
+    track_index = get_track_index()
+
+    # Corrispondenza locale sicura: nessuna chiamata di rete
+    local = track_index.lookup(title, artist)
+    if local and local[1] >= LOCAL_MATCH_THRESHOLD:
+        result.update(uuid=local[0], status=STATUS_RESOLVED, match_source='local', match_score=round(local[1], 3))
+        return result
+    
+    try:
+        items = search_soundcharts_candidates(title, artist)
+    except Exception as e:
+        print(f"Errore nella ricerca di '{title}': {e}")
+        result['status'] = STATUS_ERROR
+        return result
+
+    match = best_soundcharts_match(title, artist, items)
+    if match:
+        uuid, score = match
+        result.update(uuid=uuid, status=STATUS_RESOLVED, match_source='remote', match_score=round(score, 3))
+
+        # La traccia cercata entra nell'indice solo se la scelta è sicura: una volta
+        # indicizzata, la stessa ricerca diventa una corrispondenza esatta senza
+        # nuova verifica. Il nome canonico di SoundCharts è invece sempre quello
+        # dell'UUID (i risultati senza nome del vecchio formato API sono esclusi).
+        if score >= LOCAL_MATCH_THRESHOLD:
+            track_index.add(title, artist, uuid)
+        for item in items:
+            if item.get("uuid") == uuid and item.get("name"):
+                track_index.add(item["name"], item.get("creditName", ""), uuid)
+                break
+
+    return result
+
+FIELDNAMES = ['position', 'title', 'artist', 'uuid', 'status', 'match_source', 'match_score']
+
+# Ricerca gli UUID per un flusso di tracce, scrivendo i risultati man mano nel CSV.
+# Le tracce vengono consumate in modo incrementale: la ricerca parte appena
+# arriva la prima traccia, senza attendere la fine dell'input.
+def resolve_uuids_to_csv(rows: Iterable[Dict], output_file_path: str) -> List[Dict[str, str]]:
+    results = []
+
+    with open(output_file_path, 'w', newline='', encoding='utf-8') as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=FIELDNAMES)
+        writer.writeheader()
+
+        # Elaboriamo in parallelo mantenendo l'ordine della playlist
+        for result in ordered_map(
+            lambda item: process_single_track(item[1], item[0] + 1),
+            enumerate(rows),
+            max_workers=6
+        ):
+            writer.writerow(result)
+            results.append(result)
+    
+    return results
+
+
 # Ricerca gli UUID per tutte le tracce in un CSV
 def process_csv_and_get_uuids(csv_file_path: str, output_file_path: str) -> List[Dict[str, str]]:
     # Leggiamo il CSV di input
-    rows = []
     with open(csv_file_path, 'r', encoding='utf-8') as infile:
         reader = csv.DictReader(infile)
         rows = list(reader)
     
-    if len(rows) == 0:
-        return []
-    
-    results = []
-    
-    # Utilizziamo ThreadPoolExecutor per elaborare in parallelo
-    with ThreadPoolExecutor(max_workers=6) as executor:
-        tasks = [
-            executor.submit(process_single_track, row)
-            for row in rows
-        ]
-        
-        # Raccogliamo i risultati man mano
-        for future in as_completed(tasks):
-            result = future.result()
-            if result:
-                results.append(result)
+    return resolve_uuids_to_csv(rows, output_file_path)
 
-    with open(output_file_path, 'w', newline='', encoding='utf-8') as outfile:
-        fieldnames = ['title', 'artist', 'uuid']
-        writer = csv.DictWriter(outfile, fieldnames=fieldnames)
-        
-        writer.writeheader()
-        writer.writerows(results)
-    
-    return results
+
+# Scarica la playlist e ricerca gli UUID nello stesso processo: le pagine di
+# tracce alimentano la ricerca appena pronte, anche su playlist molto grandi
+def process_playlist_and_get_uuids(playlist_url: str, tracks_csv_path: str, output_file_path: str) -> List[Dict[str, str]]:
+    # Import locale: lo scraper serve solo in questa modalità e pesa sull'avvio
+    from linktocsvconverter import stream_playlist_to_csv
+    return resolve_uuids_to_csv(stream_playlist_to_csv(playlist_url, tracks_csv_path), output_file_path)
 
 
 if __name__ == "__main__":
     import sys
     
-    if len(sys.argv) < 3:
+    if len(sys.argv) >= 5 and sys.argv[1] == "--playlist":
+        playlist_url, tracks_csv, output_csv = sys.argv[2], sys.argv[3], sys.argv[4]
+        run = lambda: process_playlist_and_get_uuids(playlist_url, tracks_csv, output_csv)
+    elif len(sys.argv) >= 3 and sys.argv[1] != "--playlist":
+        input_csv, output_csv = sys.argv[1], sys.argv[2]
+        run = lambda: process_csv_and_get_uuids(input_csv, output_csv)
+    else:
         print("Usage: python uuidfromname.py <input_csv> <output_csv>")
+        print("       python uuidfromname.py --playlist <playlist_url> <tracks_csv> <output_csv>")
         sys.exit(1)
     
-    input_csv = sys.argv[1]
-    output_csv = sys.argv[2]
-    
     try:
-        results = process_csv_and_get_uuids(input_csv, output_csv)
+        results = run()
     except Exception as e:
         print(f"Error: {e}")
         import traceback
@@ -84,8 +84,15 @@ function TracksList({ tracks }) {
                           <div key={feature.key} className="feature-item">
                             <span className="feature-label">{feature.label}</span>
                             <div className="feature-score">
-                              <span className="score-value">{getFeatureScore(track[feature.key], feature).toFixed(2)}</span>
-                              <span className="score-max">/10</span>
+                              {track[feature.key] == null ? (
+                                // Feature non disponibile: il mood è stato stimato senza questo valore
+                                <span className="score-value">n/d</span>
+                              ) : (
+                                <>
+                                  <span className="score-value">{getFeatureScore(track[feature.key], feature).toFixed(2)}</span>
+                                  <span className="score-max">/10</span>
+                                </>
+                              )}
                             </div>
                             <div className="feature-bar">
                               <div 
@@ -1,5 +1,12 @@
 const API_BASE_URL = 'http://127.0.0.1:8000';
 
+// Campi delle tracce usati da TracksList: il backend omette tutti gli altri
+const TRACK_FIELDS = [
+  'title', 'artist', 'label',
+  'danceability', 'energy', 'speechiness', 'acousticness',
+  'instrumentalness', 'liveness', 'valence'
+];
+
 export const processPlaylist = async (playlistUrl) => {
   try {
     const response = await fetch(`${API_BASE_URL}/process-playlist`, {
@@ -7,7 +14,7 @@ export const processPlaylist = async (playlistUrl) => {
       headers: {
         'Content-Type': 'application/json',
       },
-      body: JSON.stringify({ playlist_url: playlistUrl }),
+      body: JSON.stringify({ playlist_url: playlistUrl, fields: TRACK_FIELDS }),
     });
 
     if (!response.ok) {